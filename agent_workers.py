@@ -0,0 +1,267 @@
+import os
+import json
+import uuid
+import queue
+import asyncio
+import threading
+import contextvars
+import multiprocessing
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from tracing import tracer, current_trace_id
+from metrics import registry
+
+# Agents a worker process can run, by the name jobs are submitted with
+AGENT_NAMES = ("task_agent", "user_request_agent", "ingestor")
+
+# Channel messages posted by the job a worker is running, the gateway sends them with its result
+job_notifications: contextvars.ContextVar[Optional[List[Dict[str, Any]]]] = contextvars.ContextVar("job_notifications", default=None)
+
+
+def post_from_worker(channel_id: int, content: str) -> bool:
+    """Have the gateway post a message when the job is done, False outside of a worker job"""
+    notifications = job_notifications.get()
+    if notifications is None:
+        return False
+    notifications.append({"channel_id": channel_id, "content": content})
+    return True
+
+
+class LocalQueueBackend:
+    """Job and result queues shared with worker processes on this machine"""
+
+    def __init__(self, context=None):
+        context = context or multiprocessing.get_context("spawn")
+        self.jobs = context.Queue()
+        self.results = context.Queue()
+
+    def put_job(self, job: Dict[str, Any]):
+        self.jobs.put(job)
+
+    def get_job(self, timeout: float) -> Optional[Dict[str, Any]]:
+        try:
+            return self.jobs.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def put_result(self, result: Dict[str, Any]):
+        self.results.put(result)
+
+    def get_result(self, reply_to: str, timeout: float) -> Optional[Dict[str, Any]]:
+        try:
+            return self.results.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class RedisQueueBackend:
+    """Job queue in Redis so workers on other nodes can pick up jobs, needs the redis package"""
+
+    def __init__(self, url: str, jobs_key: str = "agent_jobs"):
+        self.url = url
+        self.jobs_key = jobs_key
+        self.client = None
+
+    def __getstate__(self):
+        # Every process opens its own connection
+        return {"url": self.url, "jobs_key": self.jobs_key, "client": None}
+
+    def _client(self):
+        if self.client is None:
+            import redis
+            self.client = redis.Redis.from_url(self.url)
+        return self.client
+
+    def put_job(self, job: Dict[str, Any]):
+        self._client().lpush(self.jobs_key, json.dumps(job))
+
+    def get_job(self, timeout: float) -> Optional[Dict[str, Any]]:
+        item = self._client().brpop(self.jobs_key, timeout=max(1, int(timeout)))
+        return json.loads(item[1]) if item else None
+
+    def put_result(self, result: Dict[str, Any]):
+        self._client().lpush(f"agent_results:{result['reply_to']}", json.dumps(result, default=str))
+
+    def get_result(self, reply_to: str, timeout: float) -> Optional[Dict[str, Any]]:
+        item = self._client().brpop(f"agent_results:{reply_to}", timeout=max(1, int(timeout)))
+        return json.loads(item[1]) if item else None
+
+
+def create_queue_backend():
+    """Pick the queue backend from AGENT_QUEUE_BACKEND (local or redis) and REDIS_URL"""
+    backend = os.getenv("AGENT_QUEUE_BACKEND", "local")
+    if backend == "redis":
+        return RedisQueueBackend(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    if backend == "local":
+        return LocalQueueBackend()
+    raise ValueError(f"Unknown agent queue backend {backend}")
+
+
+def _create_agent(agent_name: str):
+    # Imported here so the gateway process doesn't need to load the agents in process mode
+    if agent_name == "task_agent":
+        from langchain_task_handler import TaskManagementAgent
+        return TaskManagementAgent(bot=None)
+    if agent_name == "user_request_agent":
+        from langchain_user_request_handler import UserRequestAgent
+        return UserRequestAgent(bot=None)
+    if agent_name == "ingestor":
+        from discord_chat_history_ingestor import DiscordChatHistoryIngestor
+        return DiscordChatHistoryIngestor(bot=None)
+    raise ValueError(f"Unknown agent {agent_name}")
+
+
+def worker_main(backend):
+    """Worker process loop: run agent jobs from the queue and push back their results"""
+    from dotenv import load_dotenv
+    load_dotenv()
+
+    loop = asyncio.new_event_loop()
+    agents = {}
+    # Spans go back to the gateway with each result, it writes TRACE_FILE
+    tracer.export_path = None
+    print(f"Agent worker {os.getpid()} started")
+
+    while True:
+        job = backend.get_job(timeout=1)
+        if job is None:
+            continue
+        if job.get("stop"):
+            break
+
+        # Tell the gateway which worker has the job, so it fails the job if this process dies
+        backend.put_result({"job_id": job["job_id"], "reply_to": job["reply_to"], "worker": os.getpid()})
+
+        notifications = []
+        job_notifications.set(notifications)
+        result = {"job_id": job["job_id"], "reply_to": job["reply_to"], "notifications": notifications}
+        metrics_before = registry.export()
+        tracer.drain()
+        try:
+            if job["agent"] not in agents:
+                agents[job["agent"]] = _create_agent(job["agent"])
+            with tracer.trace(job.get("trace_id") or job["job_id"]):
+                result["result"] = loop.run_until_complete(agents[job["agent"]].process_message(**job["kwargs"]))
+        except Exception as e:
+            print(f"Error running {job['agent']} job {job['job_id']}: {e}")
+            result["error"] = str(e)
+        # The gateway serves /metrics and the trace summary for every process
+        result["metrics"] = registry.delta(metrics_before)
+        result["spans"] = tracer.drain()
+        backend.put_result(result)
+
+
+class AgentExecutor:
+    """Runs agent jobs in a pool of worker processes and hands results back to the gateway's event loop"""
+
+    def __init__(self, backend=None, workers: Optional[int] = None, timeout: Optional[float] = None, notify: Optional[Callable[[int, str], Awaitable[Any]]] = None):
+        self.backend = backend or create_queue_backend()
+        self.notify = notify
+        self.workers = int(os.getenv("AGENT_WORKERS", os.cpu_count() or 1)) if workers is None else workers
+        self.timeout = float(os.getenv("AGENT_JOB_TIMEOUT", 600)) if timeout is None else timeout
+        self.gateway_id = uuid.uuid4().hex
+        self.processes = []
+        self.pending: Dict[str, asyncio.Future] = {}
+        # Job id to the pid of the local worker running it
+        self.running_jobs: Dict[str, int] = {}
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.running = False
+
+    def _spawn_worker(self):
+        process = multiprocessing.get_context("spawn").Process(target=worker_main, args=(self.backend,), daemon=True)
+        process.start()
+        return process
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """Start the local worker processes (AGENT_WORKERS=0 only uses workers on other nodes)"""
+        self.loop = loop or asyncio.get_event_loop()
+        self.running = True
+        self.processes = [self._spawn_worker() for _ in range(self.workers)]
+        threading.Thread(target=self._collect_results, name="agent-results", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        for _ in self.processes:
+            self.backend.put_job({"stop": True})
+
+    def _collect_results(self):
+        while self.running:
+            # Replace workers that died, eg. killed for running out of memory
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    print(f"Agent worker {process.pid} exited with {process.exitcode}, restarting")
+                    self._fail_jobs_of(process)
+                    self.processes[index] = self._spawn_worker()
+
+            result = self.backend.get_result(self.gateway_id, timeout=1)
+            if result is None:
+                continue
+            if "worker" in result:
+                self.running_jobs[result["job_id"]] = result["worker"]
+                continue
+            self.running_jobs.pop(result["job_id"], None)
+            future = self.pending.pop(result["job_id"], None)
+            if future is not None:
+                self.loop.call_soon_threadsafe(self._resolve, future, result)
+
+    def _fail_jobs_of(self, process):
+        """Fail the jobs a dead worker was running instead of leaving their callers waiting for the timeout"""
+        for job_id, pid in list(self.running_jobs.items()):
+            if pid != process.pid:
+                continue
+            del self.running_jobs[job_id]
+            future = self.pending.pop(job_id, None)
+            if future is not None:
+                self.loop.call_soon_threadsafe(self._resolve, future, {"error": f"Agent worker {pid} exited with {process.exitcode}"})
+
+    @staticmethod
+    def _resolve(future: asyncio.Future, result: Dict[str, Any]):
+        if not future.done():
+            future.set_result(result)
+
+    async def submit(self, agent_name: str, **kwargs) -> Any:
+        """Queue an agent run and wait for its result without blocking the gateway"""
+        if agent_name not in AGENT_NAMES:
+            raise ValueError(f"Unknown agent {agent_name}")
+
+        job_id = uuid.uuid4().hex
+        future = self.loop.create_future()
+        self.pending[job_id] = future
+        self.backend.put_job({
+            "job_id": job_id,
+            "reply_to": self.gateway_id,
+            "agent": agent_name,
+            "kwargs": kwargs,
+            "trace_id": current_trace_id.get(),
+        })
+        try:
+            result = await asyncio.wait_for(future, self.timeout)
+        finally:
+            self.pending.pop(job_id, None)
+            self.running_jobs.pop(job_id, None)
+
+        registry.merge(result.get("metrics") or [])
+        for span in result.get("spans") or []:
+            tracer.record(span)
+        # Posted even when the job failed afterwards, the writes they report have happened
+        for notification in result.get("notifications") or []:
+            if self.notify is None:
+                print(f"Dropping message for channel {notification['channel_id']} from {agent_name}, no notify callback")
+                continue
+            try:
+                await self.notify(notification["channel_id"], notification["content"])
+            except Exception as e:
+                print(f"Error posting message from {agent_name}: {e}")
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        return result["result"]
+
+
+if __name__ == "__main__":
+    # Extra workers on another node, eg. AGENT_QUEUE_BACKEND=redis REDIS_URL=redis://gateway:6379/0 python agent_workers.py
+    from dotenv import load_dotenv
+    load_dotenv()
+    backend = create_queue_backend()
+    if isinstance(backend, LocalQueueBackend):
+        raise SystemExit("Standalone workers need a shared queue, set AGENT_QUEUE_BACKEND=redis")
+    worker_main(backend)
@@ -0,0 +1,107 @@
+import asyncio
+import datetime
+import itertools
+from typing import List, Optional
+
+_ids = itertools.count(10**17)
+
+
+def next_id() -> int:
+    return next(_ids)
+
+
+def snowflake(created_at: datetime.datetime) -> int:
+    """Discord style id, ordered by creation time like real message ids"""
+    return int(created_at.timestamp() * 1000 - 1420070400000) << 22 | next(_ids) & 0x3FFFFF
+
+
+class FakeUser:
+    def __init__(self, name: str, user_id: Optional[int] = None):
+        self.id = user_id or next_id()
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeMessage:
+    def __init__(self, content: str, author: FakeUser, channel: "FakeChannel", mentions: List[FakeUser] = None, created_at: datetime.datetime = None):
+        self.created_at = created_at or datetime.datetime.now()
+        self.id = snowflake(self.created_at)
+        self.content = content
+        self.author = author
+        self.channel = channel
+        self.guild = None
+        self.mentions = mentions or []
+
+
+class _Typing:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FakeChannel:
+    """In-memory text channel, send() records messages and history() pages like discord.py"""
+
+    def __init__(self, name: str, channel_id: Optional[int] = None, send_latency: float = 0.0, page_size: int = 100, page_latency: float = 0.0):
+        self.id = channel_id or next_id()
+        self.name = name
+        self.messages: List[FakeMessage] = []
+        self.sent: List[str] = []
+        self.send_latency = send_latency
+        self.page_size = page_size
+        self.page_latency = page_latency
+
+    def __str__(self):
+        return self.name
+
+    async def send(self, content=None, **kwargs):
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        self.sent.append(content)
+        return content
+
+    def typing(self):
+        return _Typing()
+
+    async def history(self, limit: int = 100, after=None, oldest_first: bool = None):
+        # after is a datetime or anything with an id, discord.py returns oldest first when it is given
+        if isinstance(after, datetime.datetime):
+            messages = [message for message in self.messages if message.created_at > after]
+        else:
+            messages = [message for message in self.messages if after is None or message.id > after.id]
+        if oldest_first is False or (oldest_first is None and after is None):
+            messages = list(reversed(messages))
+        for index, message in enumerate(messages[:limit]):
+            if self.page_latency and index % self.page_size == 0:
+                await asyncio.sleep(self.page_latency)
+            yield message
+
+
+class FakeBot:
+    """Just enough of commands.Bot for on_message and the scheduled jobs"""
+
+    def __init__(self, user: FakeUser, channels: List[FakeChannel]):
+        self.user = user
+        self.channels = {channel.id: channel for channel in channels}
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        return self.channels.get(int(channel_id))
+
+    def add_channel(self, channel: FakeChannel):
+        self.channels[channel.id] = channel
+
+    async def process_commands(self, message: FakeMessage):
+        return None
+
+    async def wait_until_ready(self):
+        return None
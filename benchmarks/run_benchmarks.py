@@ -0,0 +1,183 @@
+"""Offline benchmarks for the bot, run from the repo root with: python -m benchmarks.run_benchmarks
+
+Drives on_message, the three agents and the history sweep against fake Discord
+objects and a stub chat model, so no Discord token, Ollama server or database is needed.
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import datetime
+import tracemalloc
+from typing import Awaitable, Callable, Dict, List
+
+from benchmarks.fake_discord import FakeBot, FakeChannel, FakeMessage, FakeUser
+from benchmarks.stub_llm import StubChatModel, StubTool
+
+HISTORY_CHANNEL_ID = 1264079091154423948
+TASK_CHANNEL_ID = 1361986399259332738
+ADMIN_CHANNEL_ID = 1000000000000000001
+
+TOOL_NAMES = ["fetch_employees_tool", "create_task_tool", "update_task_tool", "log_employees_to_db_from_channel_tool", "update_employee_tool", "log_employee_tool", "log_employee_schedule_tool", "get_task_tool"]
+
+SAMPLE_LINES = [
+    "morning all",
+    "please check the 9530 gate leak before you leave",
+    "ok will do",
+    "the tractor is back in the shed",
+    "make sure the garbage bins are cleared on friday",
+    "thanks!",
+]
+
+EMPLOYEES = [{"name": f"Employee {i}", "discord_id": str(i), "discord_username": f"employee_{i}"} for i in range(25)]
+
+
+def setup_environment(args):
+    """Import the bot with every external dependency replaced by an in-memory fake"""
+    os.environ.setdefault("ADMIN_BOT_DISCORD_CHANNEL_ID", str(ADMIN_CHANNEL_ID))
+    os.environ.setdefault("METRICS_PORT", "0")
+    # A fresh job store per run, otherwise windows ingested by the previous run are skipped
+    os.environ["JOB_STORE_PATH"] = os.path.join(tempfile.mkdtemp(), "jobs.sqlite3")
+
+    from model_router import ModelRouter
+    from llm_cache import wrap_with_cache
+    # LLM_CACHE_MODE=record/replay applies to the stub the same way it applies to ChatOllama
+    ModelRouter.model_factory = staticmethod(lambda model_name: wrap_with_cache(StubChatModel(model_name, latency=args.llm_latency_ms / 1000)))
+
+    import main
+    import langchain_task_handler
+    import langchain_user_request_handler
+    import discord_chat_history_ingestor
+    import task_queries
+    import task_dedup
+
+    bot_user = FakeUser("farmhand-bot")
+    channels = [
+        FakeChannel("farmhand-tasks", HISTORY_CHANNEL_ID, send_latency=args.send_latency_ms / 1000, page_latency=args.page_latency_ms / 1000),
+        FakeChannel("bot-tasks", TASK_CHANNEL_ID, send_latency=args.send_latency_ms / 1000),
+        FakeChannel("admin-bot", ADMIN_CHANNEL_ID, send_latency=args.send_latency_ms / 1000),
+        FakeChannel("general", send_latency=args.send_latency_ms / 1000),
+    ]
+    bot = FakeBot(bot_user, channels)
+
+    main.bot = bot
+    for agent in (main.agent, main.user_request_agent, main.discord_chat_history_ingestor):
+        agent.discord_bot = bot
+
+    for module in (langchain_task_handler, discord_chat_history_ingestor):
+        for tool_name in TOOL_NAMES:
+            setattr(module, tool_name, StubTool(tool_name))
+
+    langchain_user_request_handler.query_vector_db = lambda query: [{"text_content": f"Context snippet {i} about the farm."} for i in range(args.retrieved_docs)]
+    main.get_employees = lambda: EMPLOYEES
+    task_queries.get_tasks = lambda: []
+    # The dedup index loads the open tasks on its first lookup
+    task_dedup.get_tasks = lambda: []
+
+    return main, bot
+
+
+def fill_history(channel: FakeChannel, count: int):
+    authors = [FakeUser(f"employee_{i}") for i in range(5)]
+    start = datetime.datetime.now() - datetime.timedelta(days=1)
+    channel.messages = [
+        FakeMessage(SAMPLE_LINES[i % len(SAMPLE_LINES)], authors[i % len(authors)], channel, created_at=start + datetime.timedelta(seconds=i))
+        for i in range(count)
+    ]
+
+
+async def measure(name: str, operations: List[Callable[[], Awaitable]], concurrency: int) -> Dict:
+    """Run operations with bounded concurrency and report throughput, latency percentiles and peak memory"""
+    from tracing import percentile
+
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def run(operation):
+        async with semaphore:
+            started = time.perf_counter()
+            await operation()
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    await asyncio.gather(*(run(operation) for operation in operations))
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "benchmark": name,
+        "operations": len(operations),
+        "seconds": round(elapsed, 3),
+        "ops_per_second": round(len(operations) / elapsed, 2) if elapsed else None,
+        "p50_ms": round(percentile(latencies, 50), 2),
+        "p95_ms": round(percentile(latencies, 95), 2),
+        "p99_ms": round(percentile(latencies, 99), 2),
+        "peak_memory_kb": round(peak / 1024, 1),
+    }
+
+
+async def run_benchmarks(args) -> List[Dict]:
+    main, bot = setup_environment(args)
+    general = next(channel for channel in bot.channels.values() if channel.name == "general")
+    history_channel = bot.get_channel(HISTORY_CHANNEL_ID)
+    user = FakeUser("employee_0")
+    results = []
+
+    # Messages the bot should ignore, this is what on_message sees most of the time
+    ignored = [FakeMessage(SAMPLE_LINES[i % len(SAMPLE_LINES)], user, general) for i in range(args.messages)]
+    results.append(await measure("on_message_ignored", [lambda message=message: main.on_message(message) for message in ignored], args.concurrency))
+
+    mentions = [FakeMessage(f"@farmhand-bot what is on the schedule today? {i}", user, general, mentions=[bot.user]) for i in range(args.requests)]
+    results.append(await measure("on_message_mention", [lambda message=message: main.on_message(message) for message in mentions], args.concurrency))
+
+    results.append(await measure("task_agent", [
+        lambda i=i: main.agent.process_message(f"please check the gate at site {i}", str(general.id), general.name, main.SYSTEM_PROMPT)
+        for i in range(args.requests)
+    ], args.concurrency))
+
+    results.append(await measure("user_request_agent", [
+        lambda i=i: main.user_request_agent.process_message(f"who is working on friday? {i}", str(general.id), general.name, user.id, user.name)
+        for i in range(args.requests)
+    ], args.concurrency))
+
+    fill_history(history_channel, args.history_messages)
+    results.append(await measure("history_sweep", [lambda: main.scheduled_history_timeframe.coro(days_ago=5, limit=args.history_messages)], 1))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmarks with a fake Discord and a stub LLM")
+    parser.add_argument("--llm-latency-ms", type=float, default=50)
+    parser.add_argument("--send-latency-ms", type=float, default=5)
+    parser.add_argument("--page-latency-ms", type=float, default=20)
+    parser.add_argument("--messages", type=int, default=5000, help="Messages for the on_message fast path")
+    parser.add_argument("--requests", type=int, default=20, help="Requests per agent benchmark")
+    parser.add_argument("--history-messages", type=int, default=300)
+    parser.add_argument("--retrieved-docs", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--json", action="store_true", help="Print results as JSON lines")
+    args = parser.parse_args()
+
+    results = asyncio.run(run_benchmarks(args))
+
+    from tracing import tracer
+    if args.json:
+        for result in results:
+            print(json.dumps(result))
+        print(json.dumps({"stages": tracer.summary()}))
+        return
+
+    print(f"{'benchmark':<22}{'ops':>7}{'ops/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'peak KB':>10}")
+    for result in results:
+        print(f"{result['benchmark']:<22}{result['operations']:>7}{result['ops_per_second']:>10}{result['p50_ms']:>10}{result['p95_ms']:>10}{result['p99_ms']:>10}{result['peak_memory_kb']:>10}")
+    print()
+    for stage, stats in sorted(tracer.summary().items()):
+        print(f"{stage:<22}count={stats['count']:<6} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Startup time of the bot, run from the repo root with: python -m benchmarks.startup
+
+Imports each module in a fresh interpreter, so nothing is already cached, and
+compares importing main with the agents built lazily (LAZY_AGENTS=1) and eagerly (LAZY_AGENTS=0).
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+MODULES = [
+    "discord",
+    "langchain_core",
+    "langgraph.graph",
+    "langchain_ollama",
+    "models",
+    "prompts",
+    "langchain_task_handler",
+    "langchain_user_request_handler",
+    "discord_chat_history_ingestor",
+    "main",
+]
+
+AGENTS = [
+    ("langchain_task_handler", "TaskManagementAgent"),
+    ("langchain_user_request_handler", "UserRequestAgent"),
+    ("discord_chat_history_ingestor", "DiscordChatHistoryIngestor"),
+]
+
+IMPORT_SCRIPT = """
+import json, time
+started = time.perf_counter()
+import {module}
+print(json.dumps({{"seconds": time.perf_counter() - started}}))
+"""
+
+AGENT_SCRIPT = """
+import json, time
+started = time.perf_counter()
+from {module} import {cls}
+imported = time.perf_counter()
+agent = {cls}(bot=None)
+created = time.perf_counter()
+agent.graph
+print(json.dumps({{"import": imported - started, "init": created - imported, "graph": time.perf_counter() - created}}))
+"""
+
+
+def run_script(script: str, env: dict) -> dict:
+    """Run a snippet in a fresh interpreter and return the JSON it prints last"""
+    output = subprocess.run([sys.executable, "-c", script], env=env, capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def best_of(repeat: int, script: str, env: dict) -> dict:
+    runs = [run_script(script, env) for _ in range(repeat)]
+    return {key: min(run[key] for run in runs) for key in runs[0]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import and agent construction times in fresh interpreters")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per measurement, the fastest is reported")
+    args = parser.parse_args()
+
+    env = dict(os.environ, METRICS_PORT="0")
+
+    print(f"{'module':<34}{'import ms':>12}")
+    for module in MODULES:
+        try:
+            result = best_of(args.repeat, IMPORT_SCRIPT.format(module=module), env)
+            print(f"{module:<34}{result['seconds'] * 1000:>12.1f}")
+        except subprocess.CalledProcessError as e:
+            print(f"{module:<34}{'failed':>12}  {e.stderr.strip().splitlines()[-1] if e.stderr.strip() else ''}")
+
+    print()
+    print(f"{'agent':<34}{'import ms':>12}{'init ms':>12}{'graph ms':>12}")
+    for module, cls in AGENTS:
+        try:
+            result = best_of(args.repeat, AGENT_SCRIPT.format(module=module, cls=cls), env)
+            print(f"{cls:<34}{result['import'] * 1000:>12.1f}{result['init'] * 1000:>12.1f}{result['graph'] * 1000:>12.1f}")
+        except subprocess.CalledProcessError as e:
+            print(f"{cls:<34}{'failed':>12}")
+
+    print()
+    for lazy_agents in ("1", "0"):
+        try:
+            result = best_of(args.repeat, IMPORT_SCRIPT.format(module="main"), dict(env, LAZY_AGENTS=lazy_agents))
+            print(f"import main with LAZY_AGENTS={lazy_agents}: {result['seconds'] * 1000:.1f} ms")
+        except subprocess.CalledProcessError:
+            print(f"import main with LAZY_AGENTS={lazy_agents}: failed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import json
+import time
+from langchain_core.messages import AIMessage
+
+# Lines containing one of these words are treated as tasks by the stub
+TASK_KEYWORDS = ("please", "check", "fix", "need to", "make sure")
+
+
+class StubChatModel:
+    """Deterministic stand-in for ChatOllama with a configurable per-call latency"""
+
+    def __init__(self, model: str, latency: float = 0.05, seconds_per_1k_prompt_chars: float = 0.0):
+        self.model = model
+        self.latency = latency
+        self.seconds_per_1k_prompt_chars = seconds_per_1k_prompt_chars
+        self.calls = 0
+
+    def _prompt_text(self, prompt) -> str:
+        if isinstance(prompt, str):
+            return prompt
+        return "\n".join(getattr(message, "content", str(message)) for message in prompt)
+
+    def _answer(self, text: str) -> str:
+        if "Just the JSON object" not in text:
+            return "Done, here is a summary of the results above."
+
+        if "tools_needed" not in text:
+            # USER_REQUEST_OUTPUT_PROMPT only asks for a response field
+            return json.dumps({"response": "Here is what I found."})
+
+        if "START OF MESSAGE HISTORY" in text:
+            history = text.split("START OF MESSAGE HISTORY")[-1].split("END OF MESSAGE HISTORY")[0].lower()
+        else:
+            history = text.rsplit("Human:", 1)[-1].split("Format your response")[0].lower()
+        if any(keyword in history for keyword in TASK_KEYWORDS):
+            return json.dumps({
+                "response": "",
+                "tools_needed": ["create_task_tool"],
+                "tools_with_params": {"create_task_tool": {"task_name": "Stub task", "description": history.strip()[:80]}},
+                "is_task": True,
+            })
+        return json.dumps({"response": "", "tools_needed": [], "tools_with_params": {}, "is_task": False})
+
+    def invoke(self, prompt, **kwargs) -> AIMessage:
+        self.calls += 1
+        text = self._prompt_text(prompt)
+        time.sleep(self.latency + self.seconds_per_1k_prompt_chars * len(text) / 1000)
+        content = self._answer(text)
+        return AIMessage(
+            content=content,
+            usage_metadata={"input_tokens": len(text) // 4, "output_tokens": len(content) // 4, "total_tokens": (len(text) + len(content)) // 4},
+        )
+
+
+class StubTool:
+    """Tool stand-in that records its calls instead of writing to the database"""
+
+    def __init__(self, name: str, result=None):
+        self.name = name
+        self.result = result if result is not None else {"status": "ok"}
+        self.calls = []
+
+    def invoke(self, tool_input):
+        self.calls.append(tool_input)
+        return self.result
@@ -0,0 +1,293 @@
+import os
+import json
+import time
+import uuid
+import socket
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+from langchain_core.messages import BaseMessage, messages_from_dict, messages_to_dict
+
+from metrics import registry
+
+IS_LEADER = registry.gauge("coordination_is_leader", "1 while this replica holds the scheduler lease")
+LIVE_REPLICAS = registry.gauge("coordination_live_replicas", "Replicas with a recent heartbeat")
+
+SCHEDULER_LEASE = "scheduler"
+
+
+class SQLiteCoordinationBackend:
+    """Leases, replica heartbeats and conversations in SQLite
+
+    The default ":memory:" keeps everything in this process, like a single replica always did.
+    A file path lets replicas on the same host coordinate, eg. for testing a multi replica setup.
+    """
+
+    def __init__(self, path: str = ":memory:"):
+        self.path = path
+        # Only a file is seen by other processes
+        self.is_shared = path != ":memory:"
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        if path != ":memory:":
+            self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS replicas (
+                replica_id TEXT PRIMARY KEY,
+                seen_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS conversation_messages (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                conversation TEXT NOT NULL,
+                message TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS conversation_messages_conversation ON conversation_messages (conversation, seq);
+            CREATE TABLE IF NOT EXISTS high_water_marks (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS side_effects (
+                idempotency_key TEXT PRIMARY KEY,
+                result TEXT
+            );
+        """)
+
+    def _execute(self, query: str, params: tuple = ()):
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """Take the lease if it is free or expired, or extend it if we already hold it"""
+        now = time.time()
+        self._execute(
+            "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+            "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+            (name, owner, now + ttl, now),
+        )
+        rows = self._execute("SELECT owner FROM leases WHERE name = ?", (name,))
+        return bool(rows) and rows[0][0] == owner
+
+    def release_lease(self, name: str, owner: str):
+        self._execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def heartbeat(self, replica_id: str):
+        self._execute("INSERT OR REPLACE INTO replicas (replica_id, seen_at) VALUES (?, ?)", (replica_id, time.time()))
+
+    def live_replicas(self, ttl: float) -> List[str]:
+        now = time.time()
+        self._execute("DELETE FROM replicas WHERE seen_at < ?", (now - ttl * 10,))
+        return [row[0] for row in self._execute("SELECT replica_id FROM replicas WHERE seen_at >= ? ORDER BY replica_id", (now - ttl,))]
+
+    def append_messages(self, conversation: str, messages: List[Dict[str, Any]], max_messages: int):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            try:
+                self.connection.executemany(
+                    "INSERT INTO conversation_messages (conversation, message) VALUES (?, ?)",
+                    [(conversation, json.dumps(message)) for message in messages],
+                )
+                self.connection.execute(
+                    "DELETE FROM conversation_messages WHERE conversation = ? AND seq NOT IN "
+                    "(SELECT seq FROM conversation_messages WHERE conversation = ? ORDER BY seq DESC LIMIT ?)",
+                    (conversation, conversation, max_messages),
+                )
+                self.connection.execute("COMMIT")
+            except Exception:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def load_messages(self, conversation: str) -> List[Dict[str, Any]]:
+        rows = self._execute("SELECT message FROM conversation_messages WHERE conversation = ? ORDER BY seq", (conversation,))
+        return [json.loads(row[0]) for row in rows]
+
+    def high_water_mark(self, name: str) -> Optional[int]:
+        rows = self._execute("SELECT value FROM high_water_marks WHERE name = ?", (name,))
+        return rows[0][0] if rows else None
+
+    def advance_high_water_mark(self, name: str, value: int):
+        self._execute(
+            "INSERT INTO high_water_marks (name, value) VALUES (?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = excluded.value WHERE excluded.value > high_water_marks.value",
+            (name, value),
+        )
+
+    def get_side_effect(self, key: str) -> Optional[str]:
+        """JSON result of a committed side effect, None if it wasn't committed"""
+        rows = self._execute("SELECT result FROM side_effects WHERE idempotency_key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def record_side_effect(self, key: str, result: str):
+        self._execute("INSERT OR REPLACE INTO side_effects (idempotency_key, result) VALUES (?, ?)", (key, result))
+
+
+class RedisCoordinationBackend:
+    """Coordination state in Redis for replicas on different hosts, needs the redis package"""
+
+    # Extend the lease only if we still own it
+    RENEW_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end"
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) else return 0 end"
+    # Message ids don't fit a Lua number exactly, compare them as digit strings
+    ADVANCE_SCRIPT = (
+        "local v = redis.call('get', KEYS[1]) "
+        "if not v or #v < #ARGV[1] or (#v == #ARGV[1] and v < ARGV[1]) then return redis.call('set', KEYS[1], ARGV[1]) else return 0 end"
+    )
+
+    def __init__(self, url: str, prefix: str = "farmhand"):
+        self.url = url
+        self.prefix = prefix
+        self.is_shared = True
+        self.client = None
+
+    def _client(self):
+        if self.client is None:
+            import redis
+            self.client = redis.Redis.from_url(self.url, decode_responses=True)
+        return self.client
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        key = f"{self.prefix}:lease:{name}"
+        client = self._client()
+        if client.set(key, owner, nx=True, px=int(ttl * 1000)):
+            return True
+        return bool(client.eval(self.RENEW_SCRIPT, 1, key, owner, int(ttl * 1000)))
+
+    def release_lease(self, name: str, owner: str):
+        self._client().eval(self.RELEASE_SCRIPT, 1, f"{self.prefix}:lease:{name}", owner)
+
+    def heartbeat(self, replica_id: str):
+        self._client().zadd(f"{self.prefix}:replicas", {replica_id: time.time()})
+
+    def live_replicas(self, ttl: float) -> List[str]:
+        key = f"{self.prefix}:replicas"
+        now = time.time()
+        self._client().zremrangebyscore(key, 0, now - ttl * 10)
+        return sorted(self._client().zrangebyscore(key, now - ttl, "+inf"))
+
+    def append_messages(self, conversation: str, messages: List[Dict[str, Any]], max_messages: int):
+        key = f"{self.prefix}:conversation:{conversation}"
+        pipeline = self._client().pipeline()
+        pipeline.rpush(key, *[json.dumps(message) for message in messages])
+        pipeline.ltrim(key, -max_messages, -1)
+        pipeline.execute()
+
+    def load_messages(self, conversation: str) -> List[Dict[str, Any]]:
+        return [json.loads(item) for item in self._client().lrange(f"{self.prefix}:conversation:{conversation}", 0, -1)]
+
+    def high_water_mark(self, name: str) -> Optional[int]:
+        value = self._client().get(f"{self.prefix}:high_water_mark:{name}")
+        return int(value) if value is not None else None
+
+    def advance_high_water_mark(self, name: str, value: int):
+        self._client().eval(self.ADVANCE_SCRIPT, 1, f"{self.prefix}:high_water_mark:{name}", str(int(value)))
+
+    def get_side_effect(self, key: str) -> Optional[str]:
+        return self._client().get(f"{self.prefix}:side_effect:{key}")
+
+    def record_side_effect(self, key: str, result: str):
+        self._client().set(f"{self.prefix}:side_effect:{key}", result)
+
+
+def create_coordination_backend():
+    """Pick the backend from COORDINATION_BACKEND (local or redis), COORDINATION_PATH and REDIS_URL"""
+    backend = os.getenv("COORDINATION_BACKEND", "local")
+    if backend == "redis":
+        return RedisCoordinationBackend(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    if backend == "local":
+        return SQLiteCoordinationBackend(os.getenv("COORDINATION_PATH", ":memory:"))
+    raise ValueError(f"Unknown coordination backend {backend}")
+
+
+class Coordinator:
+    """Leader election for the scheduled jobs and channel ownership across bot replicas"""
+
+    def __init__(self, backend=None, replica_id: Optional[str] = None, lease_seconds: Optional[float] = None):
+        self.backend = backend or create_coordination_backend()
+        self.replica_id = replica_id or os.getenv("REPLICA_ID") or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.lease_seconds = float(os.getenv("COORDINATION_LEASE_SECONDS", 30)) if lease_seconds is None else lease_seconds
+        self.leader_until = 0.0
+        self.replicas: List[str] = [self.replica_id]
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def is_leader(self) -> bool:
+        return time.time() < self.leader_until
+
+    def refresh(self):
+        """Heartbeat, try to take or keep the scheduler lease and reload the live replicas"""
+        started = time.time()
+        self.backend.heartbeat(self.replica_id)
+        was_leader = self.is_leader
+        if self.backend.acquire_lease(SCHEDULER_LEASE, self.replica_id, self.lease_seconds):
+            # Stop acting as leader a bit before the lease runs out in the backend
+            self.leader_until = started + self.lease_seconds * 0.8
+        else:
+            self.leader_until = 0.0
+        if self.is_leader != was_leader:
+            print(f"Replica {self.replica_id} {'is now' if self.is_leader else 'is no longer'} the scheduler leader")
+        self.replicas = self.backend.live_replicas(self.lease_seconds) or [self.replica_id]
+        IS_LEADER.set(1 if self.is_leader else 0)
+        LIVE_REPLICAS.set(len(self.replicas))
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception as e:
+                print(f"Error refreshing coordination state: {e}")
+                self.leader_until = 0.0
+            await asyncio.sleep(self.lease_seconds / 3)
+
+    async def start(self):
+        """Join the replica set and keep renewing, calling it again is a no-op"""
+        if self.task is None or self.task.done():
+            await asyncio.to_thread(self.refresh)
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+        if self.is_leader:
+            self.backend.release_lease(SCHEDULER_LEASE, self.replica_id)
+            self.leader_until = 0.0
+
+    def owner_of(self, key: Any) -> str:
+        """Replica responsible for a key, by rendezvous hashing so few keys move when replicas come and go"""
+        return max(self.replicas, key=lambda replica: hashlib.sha256(f"{replica}:{key}".encode()).digest())
+
+    def owns(self, key: Any) -> bool:
+        return self.owner_of(key) == self.replica_id
+
+
+class ConversationStore:
+    """Per conversation message history shared by every replica, trimmed to the newest max_messages"""
+
+    def __init__(self, namespace: str, backend=None, max_messages: Optional[int] = None):
+        self.namespace = namespace
+        self.backend = backend or get_coordinator().backend
+        self.max_messages = int(os.getenv("CONVERSATION_MAX_MESSAGES", 50)) if max_messages is None else max_messages
+
+    def load(self, key: Any) -> List[BaseMessage]:
+        return messages_from_dict(self.backend.load_messages(f"{self.namespace}:{key}"))
+
+    def append(self, key: Any, *messages: BaseMessage):
+        self.backend.append_messages(f"{self.namespace}:{key}", messages_to_dict(list(messages)), self.max_messages)
+
+
+_coordinator = None
+
+
+def get_coordinator() -> Coordinator:
+    """Process wide coordinator, created on first use"""
+    global _coordinator
+    if _coordinator is None:
+        _coordinator = Coordinator()
+    return _coordinator
@@ -0,0 +1,66 @@
+import os
+import time
+import asyncio
+import functools
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional
+
+import src.db.db_handler as db_handler
+from metrics import registry
+
+DB_CALLS = registry.counter("db_calls_total", "Database round trips made through the pool by operation")
+DB_SECONDS = registry.histogram("db_call_seconds", "Database call duration by operation")
+
+# The database driver is blocking, calls run on this many threads so they never block the event loop
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 8))
+
+_executor: Optional[ThreadPoolExecutor] = None
+
+
+def get_db_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_POOL_SIZE, thread_name_prefix="db")
+    return _executor
+
+
+async def run_db(func: Callable, *args, operation: Optional[str] = None, **kwargs) -> Any:
+    """Run a blocking database call on the pool, keeping the caller's trace context"""
+    operation = operation or getattr(func, "__name__", "call")
+    context = contextvars.copy_context()
+    call = functools.partial(context.run, func, *args, **kwargs)
+
+    started = time.perf_counter()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(get_db_executor(), call)
+    finally:
+        DB_CALLS.inc(operation=operation)
+        DB_SECONDS.observe(time.perf_counter() - started, operation=operation)
+
+
+async def bulk_write(operation: str, items: List[Any], fallback: Callable[[Any], Any]) -> Any:
+    """Write many items in one round trip with db_handler.<operation>(items)
+
+    When db_handler has no such bulk function, fallback is called per item,
+    all on one pool thread so the event loop still only waits once.
+    """
+    if not items:
+        return []
+    bulk = getattr(db_handler, operation, None)
+    if bulk is not None:
+        return await run_db(bulk, items, operation=operation)
+    return await run_db(lambda: [fallback(item) for item in items], operation=operation)
+
+
+async def delete_tasks(task_ids: List[Any]) -> Any:
+    """Delete tasks by id, one at a time on a single pool thread until db_handler has a delete_tasks(task_ids)
+
+    That function, eg. a delete_many({"_id": {"$in": task_ids}}), makes it one round trip without changes here.
+    """
+    return await bulk_write("delete_tasks", list(task_ids), fallback=db_handler.delete_task)
+
+
+def shutdown():
+    if _executor is not None:
+        _executor.shutdown(wait=False)
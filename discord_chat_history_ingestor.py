@@ -6,18 +6,25 @@ from discord.ext import commands
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.tools import BaseTool
-from langchain_ollama import ChatOllama
 
 # LangGraph imports
 from langgraph.graph import END, StateGraph
 
 # Output Structure
 from models import AgentState, ToolCall
+from model_router import ModelRouter, invoke_json, invoke_llm
+from tracing import tracer, traced
+from metrics import TOOL_CALLS, TASKS_CREATED
+from job_store import SIDE_EFFECT_TOOLS, get_job_store, make_idempotency_key
+from task_dedup import create_task_deduplicated
 from prompts import OUTPUT_PROMPT, SYSTEM_PROMPT_FOR_CHAT_HISTORY
+from token_budget import ContextBudgeter
 from src.langchain_tools.tools import fetch_employees_tool, create_task_tool, update_task_tool, log_employees_to_db_from_channel_tool, update_employee_tool, log_employee_tool, log_employee_schedule_tool, get_task_tool
+from task_query_tool import query_tasks_tool
 
-# Define the chat model
-llm = ChatOllama(model="llama3.1", temperature=0)
+# Route classification to the small model and escalate to llama3.1 when tools are needed
+router = ModelRouter("INGESTOR")
+budgeter = ContextBudgeter("INGESTOR")
 
 
 # Create a custom tool executor
@@ -36,7 +43,11 @@ class SimpleToolExecutor:
             raise ValueError(f"Tool {tool_name} not found")
 
         tool = self.tools[tool_name]
-        return tool.invoke(tool_input)
+        TOOL_CALLS.inc(tool=tool_name)
+        if tool_name == "create_task_tool":
+            TASKS_CREATED.inc()
+        with tracer.span("tool", tool=tool_name):
+            return tool.invoke(tool_input)
 
 
 # Helper functions for RunnableSequence to process messages and handle tool parsing
@@ -97,6 +108,7 @@ def update_state_with_response(state: AgentState, llm_response) -> AgentState:
     
 
 # LangGraph nodes
+@traced("agent")
 def agent_node(state: AgentState) -> Dict:
     """Agent node that processes messages and identifies tool calls"""
     try:
@@ -105,17 +117,17 @@ def agent_node(state: AgentState) -> Dict:
             ("system", SYSTEM_PROMPT_FOR_CHAT_HISTORY),
             MessagesPlaceholder(variable_name="chat_history")
         ])
-        formatted_prompt = prompt.format(chat_history=state["messages"])
-        # Invoke with chat history
-        while True:
-            try:
-                response = llm.invoke(formatted_prompt + OUTPUT_PROMPT)
-                json.loads(response.content)
-                break
-            except Exception as e:
-                print(f"Error invoking agent_node LLM: {e}")
-                continue
-            
+        usage = budgeter.new_prompt()
+        usage.fixed("system", SYSTEM_PROMPT_FOR_CHAT_HISTORY + OUTPUT_PROMPT)
+        formatted_prompt = prompt.format(chat_history=usage.conversation(state["messages"]))
+        usage.report()
+        # Invoke with chat history, cheap classification first
+        full_prompt = formatted_prompt + OUTPUT_PROMPT
+        response = invoke_json(router.for_step("classify", full_prompt), full_prompt)
+        if router.should_escalate("classify", full_prompt, response.content):
+            # Tool parameters need the large model
+            response = invoke_json(router.for_step("extract"), full_prompt)
+
         print("response: ", response)
         # Update state with response
         return update_state_with_response(state, response)
@@ -137,30 +149,42 @@ def format_tool_results(state: AgentState, tool_results: List[Tuple[ToolCall, An
     return new_state
 
 
+@traced("execute_tools")
 def execute_tools_node(state: AgentState) -> Dict:
     """Execute tools node that runs tools and formats results"""
-    tool_executor = SimpleToolExecutor(tools=[fetch_employees_tool, create_task_tool, update_task_tool, log_employees_to_db_from_channel_tool, update_employee_tool, log_employee_tool, log_employee_schedule_tool, get_task_tool])
+    tool_executor = SimpleToolExecutor(tools=[fetch_employees_tool, create_task_tool, update_task_tool, log_employees_to_db_from_channel_tool, update_employee_tool, log_employee_tool, log_employee_schedule_tool, get_task_tool, query_tasks_tool])
     results = []
 
     task_was_created = False
 
     print(f'Current tool calls: {state["current_tool_calls"]}')
 
-    for tool_call_dict in state["current_tool_calls"]:
+    for index, tool_call_dict in enumerate(state["current_tool_calls"]):
         tool_call = ToolCall(**tool_call_dict)
 
         if tool_call.tool == "create_task_tool":
             task_was_created = True
 
-        # Channel ID injection for create_task
-        if not tool_call.tool_input.get("channel_id"):
-            tool_call.tool_input["channel_id"] = state.get("channel_id")
-        if not tool_call.tool_input.get("channel_name"):
-            tool_call.tool_input["channel_name"] = state.get("channel_name")
+        # Channel ID injection for create_task, queries search every channel unless asked for one
+        if tool_call.tool != "query_tasks_tool":
+            if not tool_call.tool_input.get("channel_id"):
+                tool_call.tool_input["channel_id"] = state.get("channel_id")
+            if not tool_call.tool_input.get("channel_name"):
+                tool_call.tool_input["channel_name"] = state.get("channel_name")
         if tool_call.tool == "log_employees_to_db_from_channel_tool":
             tool_call.tool_input["discord_bot"] = state.get("discord_bot")
 
-        result = tool_executor.invoke(tool_call)
+        invoke = lambda: tool_executor.invoke(tool_call)
+        if tool_call.tool == "create_task_tool":
+            # Overlapping windows and repeated sweeps see the same conversation
+            invoke = lambda: create_task_deduplicated(lambda: tool_executor.invoke(tool_call), tool_call.tool_input)
+
+        if state.get("idempotency_key") and tool_call.tool in SIDE_EFFECT_TOOLS:
+            # A retried window must not write the same task twice
+            side_effect_key = make_idempotency_key(state["idempotency_key"], tool_call.tool, index)
+            result = get_job_store().run_side_effect_once(side_effect_key, invoke)
+        else:
+            result = invoke()
         results.append((tool_call, result))
     
     new_state = format_tool_results(state, results)
@@ -170,16 +194,12 @@ def execute_tools_node(state: AgentState) -> Dict:
         ("system", SYSTEM_PROMPT_FOR_CHAT_HISTORY),
         MessagesPlaceholder(variable_name="chat_history")
     ])
-    formatted_prompt = prompt.format(chat_history=new_state["messages"])
+    usage = budgeter.new_prompt()
+    usage.fixed("system", SYSTEM_PROMPT_FOR_CHAT_HISTORY)
+    formatted_prompt = prompt.format(chat_history=usage.conversation(new_state["messages"]))
+    usage.report()
     
-    # Safe retry loop if response is bad JSON
-    while True:
-        try:
-            response = llm.invoke(formatted_prompt + "Respond using this format: **Task name:** <task name>\n\n**Task description:** <task description>\n\n**Task assignee:** <task assignee / discord username>.")
-            break
-        except Exception as e:
-            print("❌ Error in final response generation:", e)
-            continue
+    response = invoke_llm(router.for_step("respond"), formatted_prompt + "Respond using this format: **Task name:** <task name>\n\n**Task description:** <task description>\n\n**Task assignee:** <task assignee / discord username>.")
     # if task_was_created:
     #     task_channel_id = 1361986399259332738
     #     state['discord_bot'].get_channel(task_channel_id).send(response.content)
@@ -220,10 +240,17 @@ def build_workflow():
 
 class DiscordChatHistoryIngestor:
     def __init__(self, bot: commands.Bot):
-        self.graph = build_workflow()
+        self._graph = None
         self.discord_bot = bot
 
-    async def process_message(self, message_content: str, channel_id: str, channel_name: str) -> str:
+    @property
+    def graph(self):
+        """The compiled workflow, built on first use"""
+        if self._graph is None:
+            self._graph = build_workflow()
+        return self._graph
+
+    async def process_message(self, message_content: str, channel_id: str, channel_name: str, idempotency_key: str = None) -> str:
         """Process a message and return a response"""
         # Initialize state with just the current message, no histor
 
@@ -234,19 +261,24 @@ class DiscordChatHistoryIngestor:
             "channel_id": channel_id,
             "channel_name": channel_name,
             "current_tool_calls": [],
-            "discord_bot": self.discord_bot
+            "discord_bot": self.discord_bot,
+            "idempotency_key": idempotency_key
         }
 
-        # Run the graph
-        final_state = None
-        for output in self.graph.stream(state):
-            # Get the latest state no matter the node
-            for node_name, node_state in output.items():
-                final_state = node_state
+        # Run the graph on a thread so the event loop keeps running while the window is processed
+        final_state = await asyncio.to_thread(self.run_graph, state)
 
         # Get the last AI message as the response
         for message in reversed(final_state["messages"]):
             if isinstance(message, AIMessage):
                 return message.content
 
-        return "I processed your request, but couldn't generate a proper response."
\ No newline at end of file
+        return "I processed your request, but couldn't generate a proper response."
+
+    def run_graph(self, state: Dict) -> Dict:
+        """Run the graph and return the latest state no matter the node"""
+        final_state = None
+        for output in self.graph.stream(state):
+            for node_name, node_state in output.items():
+                final_state = node_state
+        return final_state
\ No newline at end of file
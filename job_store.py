@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+
+from coordination import get_coordinator
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# Tools that write to the database and must not run twice for the same source messages
+SIDE_EFFECT_TOOLS = {"create_task_tool", "update_task_tool", "log_employees_to_db_from_channel_tool", "update_employee_tool", "log_employee_tool", "log_employee_schedule_tool"}
+
+
+def make_idempotency_key(*parts: Any) -> str:
+    """Stable key for a unit of work, eg. make_idempotency_key("ingest", channel_id, *message_ids)"""
+    return hashlib.sha256(":".join(str(part) for part in parts).encode()).hexdigest()
+
+
+class JobStore:
+    """SQLite backed job queue with at-least-once processing and idempotent side effects
+
+    High-water marks and side effect results go to the shared coordination backend when there is one,
+    so a channel moving to a replica on another host resumes where the last one stopped. The queued
+    jobs stay in this host's file, they are finished by the replica that stored them.
+    """
+
+    def __init__(self, path: Optional[str] = None, max_attempts: int = 3, shared=None):
+        self.path = path or os.getenv("JOB_STORE_PATH", "jobs.sqlite3")
+        self.max_attempts = max_attempts
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=30)
+        # WAL lets worker processes write while the gateway reads
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                idempotency_key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                result TEXT,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_kind_status ON jobs (kind, status);
+            CREATE TABLE IF NOT EXISTS side_effects (
+                idempotency_key TEXT PRIMARY KEY,
+                result TEXT,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS high_water_marks (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        """)
+
+    def _execute(self, query: str, params: tuple = ()):
+        with self.lock:
+            return self.connection.execute(query, params).fetchall()
+
+    def enqueue(self, kind: str, key: str, payload: Dict[str, Any]) -> bool:
+        """Add a job, returns False if a job with the same key already exists"""
+        now = time.time()
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO jobs (idempotency_key, kind, payload, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, kind, json.dumps(payload, default=str), JOB_PENDING, now, now),
+            )
+            return cursor.rowcount == 1
+
+    def status(self, key: str) -> Optional[str]:
+        rows = self._execute("SELECT status FROM jobs WHERE idempotency_key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def unfinished(self, kind: str) -> List[Dict[str, Any]]:
+        """Jobs left pending or running by a previous run, oldest first"""
+        rows = self._execute(
+            "SELECT idempotency_key, payload, attempts FROM jobs WHERE kind = ? AND status IN (?, ?) AND attempts < ? ORDER BY created_at",
+            (kind, JOB_PENDING, JOB_RUNNING, self.max_attempts),
+        )
+        return [{"key": key, "payload": json.loads(payload), "attempts": attempts} for key, payload, attempts in rows]
+
+    def start(self, key: str):
+        self._execute("UPDATE jobs SET status = ?, attempts = attempts + 1, updated_at = ? WHERE idempotency_key = ?", (JOB_RUNNING, time.time(), key))
+
+    def finish(self, key: str, result: Any = None):
+        self._execute("UPDATE jobs SET status = ?, result = ?, error = NULL, updated_at = ? WHERE idempotency_key = ?", (JOB_DONE, json.dumps(result, default=str), time.time(), key))
+
+    def fail(self, key: str, error: str):
+        """Put a job back for another attempt, or give up after max_attempts"""
+        self._execute(
+            "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ?, updated_at = ? WHERE idempotency_key = ?",
+            (self.max_attempts, JOB_FAILED, JOB_PENDING, error, time.time(), key),
+        )
+
+    def high_water_mark(self, name: str) -> Optional[int]:
+        """Last id processed for a stream, eg. the newest message of a channel whose window is stored"""
+        if self.shared is not None:
+            return self.shared.high_water_mark(name)
+        rows = self._execute("SELECT value FROM high_water_marks WHERE name = ?", (name,))
+        return rows[0][0] if rows else None
+
+    def advance_high_water_mark(self, name: str, value: int):
+        """Move the mark forward, it never goes back"""
+        if self.shared is not None:
+            self.shared.advance_high_water_mark(name, value)
+            return
+        self._execute(
+            "INSERT INTO high_water_marks (name, value, updated_at) VALUES (?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET value = excluded.value, updated_at = excluded.updated_at WHERE excluded.value > high_water_marks.value",
+            (name, value, time.time()),
+        )
+
+    def run_side_effect_once(self, key: str, func):
+        """Run func unless a side effect with this key was already committed, returning the recorded result"""
+        if self.shared is not None:
+            recorded = self.shared.get_side_effect(key)
+        else:
+            rows = self._execute("SELECT result FROM side_effects WHERE idempotency_key = ?", (key,))
+            recorded = rows[0][0] if rows else None
+        if recorded is not None:
+            print(f"Skipping side effect {key[:12]}, already committed")
+            return json.loads(recorded)
+
+        result = func()
+        if self.shared is not None:
+            self.shared.record_side_effect(key, json.dumps(result, default=str))
+        else:
+            self._execute("INSERT OR REPLACE INTO side_effects (idempotency_key, result, created_at) VALUES (?, ?, ?)", (key, json.dumps(result, default=str), time.time()))
+        return result
+
+
+_job_store = None
+
+
+def get_job_store() -> JobStore:
+    """Process wide job store, opened on first use"""
+    global _job_store
+    if _job_store is None:
+        backend = get_coordinator().backend
+        _job_store = JobStore(shared=backend if backend.is_shared else None)
+    return _job_store
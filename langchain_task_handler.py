@@ -7,19 +7,27 @@ from discord.ext import commands
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.tools import BaseTool
-from langchain_ollama import ChatOllama
 
 # LangGraph imports
 from langgraph.graph import END, StateGraph
 
 # Output Structure
 from models import AgentState, ToolCall
+from model_router import ModelRouter, invoke_json, invoke_llm
+from tracing import tracer, traced
+from metrics import TOOL_CALLS, TASKS_CREATED
+from task_dedup import create_task_deduplicated
+from token_budget import ContextBudgeter
+from coordination import ConversationStore
+from agent_workers import post_from_worker
 from prompts import OUTPUT_PROMPT, SYSTEM_PROMPT
 from src.discord_bot_handler.bot_handler import BotHandler
 from src.langchain_tools.tools import fetch_employees_tool, create_task_tool, update_task_tool, log_employees_to_db_from_channel_tool, update_employee_tool, log_employee_tool, log_employee_schedule_tool, get_task_tool
+from task_query_tool import query_tasks_tool
 
-# Define the chat model
-llm = ChatOllama(model="llama3.1", temperature=0)
+# Route classification to the small model and escalate to llama3.1 when tools are needed
+router = ModelRouter("TASK_AGENT")
+budgeter = ContextBudgeter("TASK_AGENT")
 
 
 # Create a custom tool executor
@@ -38,8 +46,12 @@ class SimpleToolExecutor:
             raise ValueError(f"Tool {tool_name} not found")
 
         tool = self.tools[tool_name]
-        print("tool_input: ", tool_input)
-        return tool.invoke(tool_input)
+        TOOL_CALLS.inc(tool=tool_name)
+        if tool_name == "create_task_tool":
+            TASKS_CREATED.inc()
+        with tracer.span("tool", tool=tool_name):
+            print("tool_input: ", tool_input)
+            return tool.invoke(tool_input)
 
 
 # Helper functions for RunnableSequence to process messages and handle tool parsing
@@ -100,6 +112,7 @@ def update_state_with_response(state: AgentState, llm_response) -> AgentState:
     
 
 # LangGraph nodes
+@traced("agent")
 def agent_node(state: AgentState) -> Dict:
     """Agent node that processes messages and identifies tool calls"""
     try:
@@ -108,19 +121,19 @@ def agent_node(state: AgentState) -> Dict:
             ("system", state['prompt']),
             MessagesPlaceholder(variable_name="chat_history"),
         ])
-    
-        formatted_prompt = prompt.format(chat_history=state["messages"])
 
-        # Invoke with chat history
-        while True:
-            try:
-                response = llm.invoke(formatted_prompt + OUTPUT_PROMPT)
-                json.loads(response.content)
-                break
-            except Exception as e:
-                print(f"Error invoking agent_node LLM: {e}")
-                continue
-            
+        usage = budgeter.new_prompt()
+        usage.fixed("system", state['prompt'] + OUTPUT_PROMPT)
+        formatted_prompt = prompt.format(chat_history=usage.conversation(state["messages"]))
+        usage.report()
+
+        # Invoke with chat history, cheap classification first
+        full_prompt = formatted_prompt + OUTPUT_PROMPT
+        response = invoke_json(router.for_step("classify", full_prompt), full_prompt)
+        if router.should_escalate("classify", full_prompt, response.content):
+            # Tool parameters need the large model
+            response = invoke_json(router.for_step("extract"), full_prompt)
+
         print("response: ", response)
         # Update state with response
         return update_state_with_response(state, response)
@@ -143,9 +156,10 @@ def format_tool_results(state: AgentState, tool_results: List[Tuple[ToolCall, An
     return new_state
 
 
+@traced("execute_tools")
 def execute_tools_node(state: AgentState) -> Dict:
     """Execute tools node that runs tools and formats results"""
-    tool_executor = SimpleToolExecutor(tools=[fetch_employees_tool, create_task_tool, update_task_tool, log_employees_to_db_from_channel_tool, update_employee_tool, log_employee_tool, log_employee_schedule_tool, get_task_tool])
+    tool_executor = SimpleToolExecutor(tools=[fetch_employees_tool, create_task_tool, update_task_tool, log_employees_to_db_from_channel_tool, update_employee_tool, log_employee_tool, log_employee_schedule_tool, get_task_tool, query_tasks_tool])
     results = []
 
     task_was_created = False
@@ -156,15 +170,19 @@ def execute_tools_node(state: AgentState) -> Dict:
         if tool_call.tool == "create_task_tool":
             task_was_created = True
 
-        # Channel ID injection for create_task
-        if not tool_call.tool_input.get("channel_id"):
-            tool_call.tool_input["channel_id"] = state.get("channel_id")
-        if not tool_call.tool_input.get("channel_name"):
-            tool_call.tool_input["channel_name"] = state.get("channel_name")
+        # Channel ID injection for create_task, queries search every channel unless asked for one
+        if tool_call.tool != "query_tasks_tool":
+            if not tool_call.tool_input.get("channel_id"):
+                tool_call.tool_input["channel_id"] = state.get("channel_id")
+            if not tool_call.tool_input.get("channel_name"):
+                tool_call.tool_input["channel_name"] = state.get("channel_name")
         if tool_call.tool == "log_employees_to_db_from_channel_tool":
             tool_call.tool_input["discord_bot"] = state.get("discord_bot")
 
-        result = tool_executor.invoke(tool_call)
+        if tool_call.tool == "create_task_tool":
+            result = create_task_deduplicated(lambda: tool_executor.invoke(tool_call), tool_call.tool_input)
+        else:
+            result = tool_executor.invoke(tool_call)
         results.append((tool_call, result))
     
     new_state = format_tool_results(state, results)
@@ -174,19 +192,16 @@ def execute_tools_node(state: AgentState) -> Dict:
         ("system", SYSTEM_PROMPT),
         MessagesPlaceholder(variable_name="chat_history"),
     ])
-    formatted_prompt = prompt.format(chat_history=new_state["messages"])
+    usage = budgeter.new_prompt()
+    usage.fixed("system", SYSTEM_PROMPT)
+    formatted_prompt = prompt.format(chat_history=usage.conversation(new_state["messages"]))
+    usage.report()
     
-    # Safe retry loop if response is bad JSON
-    while True:
-        try:
-            response = llm.invoke(formatted_prompt + "\n\nRespond in a conversational way summarizing the results above.")
-            break
-        except Exception as e:
-            print("❌ Error in final response generation:", e)
-            continue
+    response = invoke_llm(router.for_step("respond"), formatted_prompt + "\n\nRespond in a conversational way summarizing the results above.")
     if task_was_created:
+        # Posted by process_message on the event loop, the graph runs on a thread and maybe in a worker process
         task_channel_id = 1361986399259332738
-        state['discord_bot'].get_channel(task_channel_id).send(response.content)
+        new_state["notifications"] = new_state.get("notifications", []) + [{"channel_id": task_channel_id, "content": response.content}]
     new_state["messages"].append(response)
     return new_state
 
@@ -225,23 +240,30 @@ def build_workflow():
 # Create the task management agent
 class TaskManagementAgent:
     def __init__(self, bot: commands.Bot):
-        self.graph = build_workflow()
-        self.conversation_history = {}  # Keyed by channel_id
+        self._graph = None
+        self.conversation_history = ConversationStore("task_agent")  # Keyed by channel_id, shared by every replica
         self.discord_bot = bot
 
+    @property
+    def graph(self):
+        """The compiled workflow, built on first use"""
+        if self._graph is None:
+            self._graph = build_workflow()
+        return self._graph
+
     async def process_message(self, message_content: str, channel_id: str, channel_name: str, prompt: str) -> str:
         """Process a message and return a response"""
         # Initialize state with just the current message, no history
 
-        if channel_id not in self.conversation_history:
-            self.conversation_history[channel_id] = []
+        history = await asyncio.to_thread(self.conversation_history.load, channel_id)
 
         # Add the new message to history
-        self.conversation_history[channel_id].append(HumanMessage(content=message_content))
+        history.append(HumanMessage(content=message_content))
+        await asyncio.to_thread(self.conversation_history.append, channel_id, history[-1])
 
         state = {
             "input": HumanMessage(content=message_content),
-            "messages": self.conversation_history[channel_id].copy(),
+            "messages": history,
             "channel_id": channel_id,
             "channel_name": channel_name,
             "current_tool_calls": [],
@@ -249,20 +271,37 @@ class TaskManagementAgent:
             "prompt": prompt
         }
 
-        # Run the graph
-        final_state = None
-        for output in self.graph.stream(state):
-            # Get the latest state no matter the node
-            for node_name, node_state in output.items():
-                final_state = node_state
+        # Run the graph on a thread so concurrent requests don't queue up behind each other on the event loop
+        final_state = await asyncio.to_thread(self.run_graph, state)
+        for notification in final_state.get("notifications") or []:
+            await self.notify(notification["channel_id"], notification["content"])
 
         # Get the last AI message as the response
         for message in reversed(final_state["messages"]):
             if isinstance(message, AIMessage):
-                self.conversation_history[channel_id].append(AIMessage(content=message.content))
+                await asyncio.to_thread(self.conversation_history.append, channel_id, AIMessage(content=message.content))
                 return message.content
 
         return "I processed your request, but couldn't generate a proper response."
+
+    async def notify(self, channel_id: int, content: str):
+        """Post to a channel, in a worker process the gateway posts it along with the job's result"""
+        if self.discord_bot is None:
+            if not post_from_worker(channel_id, content):
+                print(f"No Discord client to post to channel {channel_id}")
+            return
+        try:
+            await self.discord_bot.get_channel(channel_id).send(content)
+        except Exception as e:
+            print(f"Error sending to channel {channel_id}: {e}")
+
+    def run_graph(self, state: Dict) -> Dict:
+        """Run the graph and return the latest state no matter the node"""
+        final_state = None
+        for output in self.graph.stream(state):
+            for node_name, node_state in output.items():
+                final_state = node_state
+        return final_state
     
 
 # Example usage
@@ -1,43 +1,61 @@
 import json
+import asyncio
 from typing import Dict
 from discord.ext import commands
 from langchain_core.messages import HumanMessage, AIMessage
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
-from langchain_ollama import ChatOllama
 from models import UserRequestState
 from langgraph.graph import StateGraph
 from src.db.db_handler import query_vector_db
 from prompts import USER_REQUEST_PROMPT, USER_REQUEST_OUTPUT_PROMPT
+from model_router import ModelRouter, invoke_json
+from token_budget import ContextBudgeter
+from db_pool import run_db
+from coordination import ConversationStore
+from tracing import tracer, traced
 
-llm = ChatOllama(model="llama3.1", temperature=0)
+# Conversational answers always run on the large model
+router = ModelRouter("USER_REQUEST")
+budgeter = ContextBudgeter("USER_REQUEST")
+
+# Everything before the retrieved context never changes, the model can process it while retrieval runs
+PROMPT_PREFIX = "System: " + USER_REQUEST_PROMPT.split("{context}")[0]
+
+
+def retrieve(query: str):
+    with tracer.span("retrieval"):
+        return query_vector_db(query)
 
     
+@traced("agent")
 def agent_node(state: UserRequestState) -> Dict:
     """Agent node that processes messages and identifies tool calls"""
     try:
-        results = query_vector_db(state["input"].content)
+        results = state.get("retrieved")
+        if results is None:
+            results = retrieve(state["input"].content)
         print(results)
 
+        # Retrieved documents are kept in ranked order until the context budget is used up
+        usage = budgeter.new_prompt()
+        usage.fixed("system", USER_REQUEST_PROMPT.format(context="", user_message="") + USER_REQUEST_OUTPUT_PROMPT)
+        context = usage.documents("context", [result["text_content"] for result in results])
+        user_message = usage.text("user_message", state["input"].content)
+
         # Create prompt template with messages placeholder
         prompt = ChatPromptTemplate.from_messages([
-            ("system", USER_REQUEST_PROMPT.format(context="\n".join([result["text_content"] for result in results]), user_message=state["input"].content)),
+            ("system", USER_REQUEST_PROMPT.format(context="\n".join(context), user_message=user_message)),
             MessagesPlaceholder(variable_name="chat_history"),
         ])
     
-        formatted_prompt = prompt.format(chat_history=state["messages"])
+        formatted_prompt = prompt.format(chat_history=usage.conversation(state["messages"]))
+        usage.report()
 
         print("formatted_prompt: ", formatted_prompt)
 
         # Invoke with chat history
-        while True:
-            try:
-                response = llm.invoke(formatted_prompt + USER_REQUEST_OUTPUT_PROMPT)
-                json.loads(response.content)
-                break
-            except Exception as e:
-                print(f"Error invoking agent_node LLM: {e}")
-                continue
-            
+        response = invoke_json(router.for_step("respond"), formatted_prompt + USER_REQUEST_OUTPUT_PROMPT)
+
         print("response: ", response)
         return {"messages": [AIMessage(content=json.loads(response.content)['response'])]}
     except Exception as e:
@@ -59,12 +77,19 @@ def build_workflow():
 
 class UserRequestAgent:
     def __init__(self, bot: commands.Bot):
-        self.graph = build_workflow()
-        self.conversation_history = {}  # Keyed by user_discord_id
+        self._graph = None
+        self.conversation_history = ConversationStore("user_request_agent")  # Keyed by user_discord_id, shared by every replica
         self.user_discord_id = ''
         self.user_name = ''
         self.discord_bot = bot
         
+    @property
+    def graph(self):
+        """The compiled workflow, built on first use"""
+        if self._graph is None:
+            self._graph = build_workflow()
+        return self._graph
+        
     async def process_message(self, message_content: str, channel_id: str, channel_name: str, user_discord_id: str, user_name: str) -> str:
         """Process a message and return a response"""
         # Initialize state with just the current message, no history
@@ -72,32 +97,49 @@ class UserRequestAgent:
         self.user_discord_id = user_discord_id
         self.user_name = user_name
 
-        if self.user_discord_id not in self.conversation_history:
-            self.conversation_history[self.user_discord_id] = []
+        # Retrieval starts right away and the model prefills the static prompt prefix meanwhile
+        retrieval = asyncio.create_task(run_db(retrieve, message_content, operation="query_vector_db"))
+        prefill = asyncio.create_task(asyncio.to_thread(router.prefill, "respond", PROMPT_PREFIX))
 
         # Add the new message to history
-        self.conversation_history[self.user_discord_id].append(HumanMessage(content=message_content))
+        history = await asyncio.to_thread(self.conversation_history.load, user_discord_id)
+        history.append(HumanMessage(content=message_content))
+        await asyncio.to_thread(self.conversation_history.append, user_discord_id, history[-1])
+
+        try:
+            retrieved = await retrieval
+        except Exception as e:
+            # agent_node tries again and handles the error like before
+            print(f"Error retrieving context: {e}")
+            retrieved = None
 
         state = {
             "input": HumanMessage(content=message_content),
-            "messages": self.conversation_history[self.user_discord_id].copy(),  # Only include current message
+            "messages": history,
             "discord_bot": self.discord_bot,
             "channel_id": channel_id,
-            "channel_name": channel_name
+            "channel_name": channel_name,
+            "retrieved": retrieved,
         }
         
-        # Run the graph
-        final_state = None
-        for output in self.graph.stream(state):
-            # Get the latest state no matter the node
-            for node_name, node_state in output.items():
-                final_state = node_state
+        # Generation starts as soon as the context is in, on a thread so the event loop keeps running
+        final_state = await asyncio.to_thread(self.run_graph, state)
+        # The one token prefill is done long before the answer, this only keeps it tied to the request
+        await prefill
 
         # Get the last AI message as the response
         for message in reversed(final_state["messages"]):
             if isinstance(message, AIMessage):
-                self.conversation_history[self.user_discord_id].append(AIMessage(content=message.content))
+                await asyncio.to_thread(self.conversation_history.append, user_discord_id, AIMessage(content=message.content))
                 return message.content
 
         return "I processed your request, but couldn't generate a proper response."
+
+    def run_graph(self, state: Dict) -> Dict:
+        """Run the graph and return the latest state no matter the node"""
+        final_state = None
+        for output in self.graph.stream(state):
+            for node_name, node_state in output.items():
+                final_state = node_state
+        return final_state
     
\ No newline at end of file
@@ -0,0 +1,55 @@
+import os
+import time
+import asyncio
+import threading
+from typing import Any, Callable
+
+# LAZY_AGENTS=0 builds every agent while main is imported, like before
+LAZY_AGENTS = os.getenv("LAZY_AGENTS", "1") not in ("0", "false", "False")
+
+
+class LazyObject:
+    """Stands in for an expensive object and builds it on first use"""
+
+    def __init__(self, name: str, factory: Callable[[], Any]):
+        object.__setattr__(self, "_name", name)
+        object.__setattr__(self, "_factory", factory)
+        object.__setattr__(self, "_instance", None)
+        object.__setattr__(self, "_lock", threading.Lock())
+
+    def get(self) -> Any:
+        if self._instance is None:
+            with self._lock:
+                if self._instance is None:
+                    started = time.perf_counter()
+                    object.__setattr__(self, "_instance", self._factory())
+                    print(f"Initialized {self._name} in {time.perf_counter() - started:.2f}s")
+        return self._instance
+
+    @property
+    def is_ready(self) -> bool:
+        return self._instance is not None
+
+    async def warm(self, *attributes: str):
+        """Build the object and touch the given lazy attributes on a thread so the event loop keeps serving Discord"""
+        if not self.is_ready or attributes:
+            await asyncio.to_thread(self._warm, attributes)
+
+    def _warm(self, attributes):
+        instance = self.get()
+        for name in attributes:
+            getattr(instance, name)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.get(), name)
+
+    def __setattr__(self, name: str, value: Any):
+        setattr(self.get(), name, value)
+
+
+def lazy(name: str, factory: Callable[[], Any]) -> LazyObject:
+    """Wrap a factory, building it right away when LAZY_AGENTS is off"""
+    lazy_object = LazyObject(name, factory)
+    if not LAZY_AGENTS:
+        lazy_object.get()
+    return lazy_object
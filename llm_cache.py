@@ -0,0 +1,124 @@
+import os
+import json
+import hashlib
+import threading
+from typing import Any, Dict, Optional
+from langchain_core.messages import AIMessage
+
+from metrics import registry
+
+CACHE_MODES = ("passthrough", "record", "replay")
+
+LLM_CACHE_LOOKUPS = registry.counter("llm_cache_lookups_total", "Completion cache lookups by result (hit or miss)")
+
+# Model options that change the completion and therefore belong in the cache key
+KEY_OPTIONS = ("temperature", "top_k", "top_p", "num_ctx", "num_predict", "seed", "stop", "format")
+
+
+class CacheMiss(KeyError):
+    """Raised in replay mode when a prompt has no recorded completion"""
+
+
+def _prompt_to_text(prompt) -> str:
+    if isinstance(prompt, str):
+        return prompt
+    return json.dumps([{"type": getattr(message, "type", None), "content": getattr(message, "content", str(message))} for message in prompt])
+
+
+def cache_key(model_name: str, options: Dict[str, Any], prompt) -> str:
+    """Content address of a completion: model name, model options and the full formatted prompt"""
+    payload = json.dumps({"model": model_name, "options": options, "prompt": _prompt_to_text(prompt)}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class CachedChatModel:
+    """Wraps a chat model with an on-disk completion cache
+
+    passthrough: always call the model
+    record: return recorded completions, call the model and record on a miss
+    replay: only return recorded completions, raise CacheMiss otherwise
+    """
+
+    def __init__(self, llm, mode: str = "record", cache_dir: str = ".llm_cache"):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"Unknown cache mode {mode}, expected one of {CACHE_MODES}")
+        self.llm = llm
+        self.mode = mode
+        self.cache_dir = cache_dir
+        self.memory: Dict[str, Dict[str, Any]] = {}
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        # Everything else (model, temperature, ...) comes from the wrapped model
+        return getattr(self.llm, name)
+
+    @property
+    def options(self) -> Dict[str, Any]:
+        return {option: getattr(self.llm, option, None) for option in KEY_OPTIONS}
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _load(self, key: str) -> Optional[Dict[str, Any]]:
+        with self.lock:
+            if key in self.memory:
+                return self.memory[key]
+        try:
+            with open(self._path(key)) as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        with self.lock:
+            self.memory[key] = entry
+        return entry
+
+    def _store(self, key: str, entry: Dict[str, Any]):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so concurrent readers never see a partial file
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.memory[key] = entry
+
+    def discard(self, prompt, **kwargs):
+        """Forget a recorded completion, eg. one that turned out to be invalid JSON"""
+        key = cache_key(self.llm.model, {**self.options, **kwargs}, prompt)
+        with self.lock:
+            self.memory.pop(key, None)
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def invoke(self, prompt, **kwargs) -> AIMessage:
+        if self.mode == "passthrough":
+            return self.llm.invoke(prompt, **kwargs)
+
+        key = cache_key(self.llm.model, {**self.options, **kwargs}, prompt)
+        entry = self._load(key)
+        if entry is not None:
+            LLM_CACHE_LOOKUPS.inc(result="hit")
+            return AIMessage(content=entry["content"], usage_metadata=entry.get("usage_metadata"), response_metadata={"cache_hit": True})
+
+        LLM_CACHE_LOOKUPS.inc(result="miss")
+        if self.mode == "replay":
+            raise CacheMiss(f"No recorded completion for {self.llm.model} prompt {key}")
+
+        response = self.llm.invoke(prompt, **kwargs)
+        self._store(key, {
+            "model": self.llm.model,
+            "content": response.content,
+            "usage_metadata": getattr(response, "usage_metadata", None),
+        })
+        return response
+
+
+def wrap_with_cache(llm):
+    """Wrap a chat model according to LLM_CACHE_MODE and LLM_CACHE_DIR"""
+    mode = os.getenv("LLM_CACHE_MODE", "passthrough")
+    if mode == "passthrough":
+        return llm
+    return CachedChatModel(llm, mode=mode, cache_dir=os.getenv("LLM_CACHE_DIR", ".llm_cache"))
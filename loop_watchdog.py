@@ -0,0 +1,105 @@
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import threading
+import traceback
+from collections import Counter as StackCounter
+from typing import Optional
+
+from metrics import registry
+
+EVENT_LOOP_LAG = registry.histogram("event_loop_lag_seconds", "How late the event loop woke up from a sleep", buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+EVENT_LOOP_STALLS = registry.counter("event_loop_stalls_total", "Times the event loop was blocked for longer than LOOP_LAG_THRESHOLD_MS")
+
+
+class LoopWatchdog:
+    """Measures event loop lag and dumps the stack of whatever blocks the loop for too long
+
+    A task on the loop updates a heartbeat every interval. A separate thread checks the
+    heartbeat, so it still runs while the loop is blocked and can capture the blocking stack.
+    """
+
+    def __init__(self, threshold: Optional[float] = None, interval: Optional[float] = None):
+        self.threshold = float(os.getenv("LOOP_LAG_THRESHOLD_MS", 250)) / 1000 if threshold is None else threshold
+        self.interval = float(os.getenv("LOOP_LAG_INTERVAL_MS", 100)) / 1000 if interval is None else interval
+        self.heartbeat = time.monotonic()
+        self.loop_thread_id: Optional[int] = None
+        self.task: Optional[asyncio.Task] = None
+        self.running = False
+
+    def start(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """Start watching the running loop, calling it again is a no-op"""
+        if self.running:
+            return
+        loop = loop or asyncio.get_running_loop()
+        self.running = True
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = loop.create_task(self._measure())
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _measure(self):
+        while self.running:
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            EVENT_LOOP_LAG.observe(max(0.0, now - started - self.interval))
+            self.heartbeat = now
+
+    def _watch(self):
+        reported_heartbeat = None
+        while self.running:
+            time.sleep(self.interval)
+            heartbeat = self.heartbeat
+            blocked = time.monotonic() - heartbeat - self.interval
+            # Report each stall once, while it is still happening so the stack is the blocking one
+            if blocked > self.threshold and heartbeat != reported_heartbeat:
+                reported_heartbeat = heartbeat
+                EVENT_LOOP_STALLS.inc()
+                frame = sys._current_frames().get(self.loop_thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no stack)\n"
+                print(f"Event loop blocked for {blocked * 1000:.0f}ms, stack of the loop thread:\n{stack}")
+
+
+def _collapse(frame) -> str:
+    """One stack as root;...;leaf, the format flamegraph.pl and speedscope read"""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+
+def sample_stacks(seconds: float, interval: float = 0.005) -> StackCounter:
+    """Sample the stacks of every other thread for a while and count identical stacks"""
+    samples = StackCounter()
+    own_thread = threading.get_ident()
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id != own_thread:
+                samples[f"{names.get(thread_id, thread_id)};{_collapse(frame)}"] += 1
+        time.sleep(interval)
+    return samples
+
+
+async def profile_to_file(seconds: float, interval: float = 0.005, directory: Optional[str] = None) -> str:
+    """Profile the process on a thread without blocking the loop and write the collapsed stacks to a file"""
+    samples = await asyncio.to_thread(sample_stacks, seconds, interval)
+    fd, path = tempfile.mkstemp(prefix="profile-", suffix=".folded", dir=directory)
+    with os.fdopen(fd, "w") as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+    return path
+
+
+watchdog = LoopWatchdog()
@@ -8,13 +8,26 @@ from dotenv import load_dotenv
 from src.discord_bot_handler.bot_handler import BotHandler
 from src.discord_bot_handler.paginators.user_log_paginator import UserLogPaginator
 from src.discord_bot_handler.paginators.employee_schedule_paginator import EmployeeSchedulePaginator
-from langchain_task_handler import TaskManagementAgent
-from langchain_user_request_handler import UserRequestAgent
-from discord_chat_history_ingestor import DiscordChatHistoryIngestor
 import asyncio
-from src.db.db_handler import get_employees, log_discord_chat_history, get_tasks, delete_task
+from src.db.db_handler import get_employees, log_discord_chat_history
 from prompts import SYSTEM_PROMPT_FOR_CHAT_HISTORY, SYSTEM_PROMPT
-from src.langchain_tools.utils.utils import remove_angle_bracket_content
+from windowing import iter_chat_lines, iter_windows, prefetch, WINDOW_TOKENS, MIN_WINDOW_TOKENS
+from tracing import tracer
+from agent_workers import AgentExecutor
+from job_store import get_job_store, make_idempotency_key
+from task_dedup import get_task_dedup_index
+from lazy_init import lazy
+from roster_cache import CachedDataset, send_view
+from token_budget import ContextBudgeter
+from loop_watchdog import watchdog, profile_to_file
+from task_queries import query_tasks
+from models import TaskQuery
+from db_pool import run_db, delete_tasks
+from coordination import get_coordinator
+from single_flight import SingleFlight, single_flight_key
+from message_router import MessageRouter, ROUTE_IGNORE, ROUTE_INGEST, ROUTE_ADMIN_AGENT, ROUTE_MENTION_AGENT
+from metrics import MESSAGES_SEEN, AGENT_RUNS, AGENT_RUNS_IN_PROGRESS, AGENT_RUN_SECONDS, REMINDERS_SENT, DISCORD_RATE_LIMITED, start_metrics_server, count_discord_rate_limits
+import time
 
 # Load environment variables
 load_dotenv()
@@ -23,9 +36,106 @@ TOKEN = os.getenv("DISCORD_BOT_TOKEN")
 bot_handler = BotHandler()
 bot = bot_handler.bot
 
-agent = TaskManagementAgent(bot=bot)
-user_request_agent = UserRequestAgent(bot=bot)
-discord_chat_history_ingestor = DiscordChatHistoryIngestor(bot=bot)
+
+# The agent modules pull in langchain, langgraph and the tools, so they are only imported when first used
+def create_task_agent():
+    from langchain_task_handler import TaskManagementAgent
+    return TaskManagementAgent(bot=bot)
+
+
+def create_user_request_agent():
+    from langchain_user_request_handler import UserRequestAgent
+    return UserRequestAgent(bot=bot)
+
+
+def create_chat_history_ingestor():
+    from discord_chat_history_ingestor import DiscordChatHistoryIngestor
+    return DiscordChatHistoryIngestor(bot=bot)
+
+
+agent = lazy("TaskManagementAgent", create_task_agent)
+user_request_agent = lazy("UserRequestAgent", create_user_request_agent)
+discord_chat_history_ingestor = lazy("DiscordChatHistoryIngestor", create_chat_history_ingestor)
+message_router = MessageRouter()
+# Employees for the history sweep prompts, instead of reading them from the database for every channel
+employee_roster = CachedDataset("employees", lambda: get_employees(), sort_key=lambda employee: employee['name'].lower())
+ingestor_budgeter = ContextBudgeter("INGESTOR")
+# "EMPLOYEES: ... MESSAGES: ..." and the history markers the ingestor wraps it in, with some slack
+INGEST_PROMPT_OVERHEAD_TOKENS = 48
+
+# Elects the replica that runs the scheduled jobs and splits channels between replicas
+coordinator = get_coordinator()
+
+# The reminder job sends every overdue reminder and deletes ONCE tasks, it only runs when switched on
+REMINDERS_ENABLED = os.getenv("REMINDERS_ENABLED", "0") not in ("0", "false", "False", "")
+
+# Set when AGENT_EXECUTION_MODE=process, agents then run in worker processes instead of the gateway
+agent_executor = None
+
+# A user repeating a question while it is being answered shares the answer, in either execution mode
+user_request_flight = SingleFlight("user_request_agent")
+
+
+async def send_message(channel, content, **kwargs):
+    """Send a message to a Discord channel, recording the API call"""
+    with tracer.span("discord_send", channel_id=channel.id):
+        try:
+            return await channel.send(content, **kwargs)
+        except discord.HTTPException as e:
+            if e.status == 429:
+                DISCORD_RATE_LIMITED.inc()
+            raise
+
+
+async def run_agent(agent_name, **kwargs):
+    """Run an agent, identical user requests already in flight wait for that run instead"""
+    if agent_name == "user_request_agent":
+        # The answer depends on the asker's own history, so only their own repeats are coalesced
+        key = single_flight_key(kwargs["channel_id"], kwargs["user_discord_id"], kwargs["message_content"])
+        response, _ = await user_request_flight.do(key, lambda: execute_agent(agent_name, **kwargs))
+        return response
+    return await execute_agent(agent_name, **kwargs)
+
+
+async def execute_agent(agent_name, **kwargs):
+    """Run an agent inline or on a worker process, recording how many runs are in flight and how long they take"""
+    AGENT_RUNS.inc(agent=agent_name)
+    AGENT_RUNS_IN_PROGRESS.inc(agent=agent_name)
+    started = time.perf_counter()
+    try:
+        if agent_executor is not None:
+            return await agent_executor.submit(agent_name, **kwargs)
+
+        agents = {"task_agent": agent, "user_request_agent": user_request_agent, "ingestor": discord_chat_history_ingestor}
+        # Build the agent off the event loop if on_ready hasn't got to it yet
+        await agents[agent_name].warm()
+        return await agents[agent_name].process_message(**kwargs)
+    finally:
+        AGENT_RUNS_IN_PROGRESS.dec(agent=agent_name)
+        AGENT_RUN_SECONDS.observe(time.perf_counter() - started, agent=agent_name)
+
+
+async def warm_agents():
+    """Build the agents in the background once the bot is connected, so the first request doesn't pay for it"""
+    if agent_executor is not None:
+        # Agents run in the worker processes
+        return
+    for lazy_agent in (agent, user_request_agent, discord_chat_history_ingestor):
+        # The LangGraph workflow is compiled on first use too
+        await lazy_agent.warm("graph")
+
+bot.add_listener(warm_agents, "on_ready")
+
+
+async def warm_roster():
+    """Load the employees before the first history sweep"""
+    try:
+        await employee_roster.refresh()
+    except Exception as e:
+        print(f"Error loading employees: {e}")
+
+bot.add_listener(warm_roster, "on_ready")
+
 
 @bot.tree.command(name="log-admin", description="Log an admin to database", guild=bot_handler.guild)
 @app_commands.describe(name="Admin Full Name")
@@ -35,8 +145,7 @@ async def log_admin(interaction: discord.Interaction, name: str):
         return
 
     admin_paginator_view = UserLogPaginator(user_name=name, user_type='admin')
-    admin_paginator_view.update_dropdown()
-    await interaction.response.send_message("Please Select Admin Job Type:", view=admin_paginator_view)
+    await send_view(interaction, "Please Select Admin Job Type:", admin_paginator_view)
 
 
 @bot.tree.command(name="log-employee", description="Log an employee to database", guild=bot_handler.guild)
@@ -47,21 +156,60 @@ async def log_admin(interaction: discord.Interaction, name: str):
         return
 
     admin_paginator_view = UserLogPaginator(user_name=name, user_type='employee')
-    admin_paginator_view.update_dropdown()
-    await interaction.response.send_message("Please Select Employee Job Type:", view=admin_paginator_view)
+    await send_view(interaction, "Please Select Employee Job Type:", admin_paginator_view)
 
 
 @bot.tree.command(name="log-employee-schedule", description="Log an employee schedule to database", guild=bot_handler.guild)
 @app_commands.describe()
 async def log_admin(interaction: discord.Interaction):
     employee_schedule_paginator = EmployeeSchedulePaginator()
-    employee_schedule_paginator.update_dropdown()
-    await interaction.response.send_message("Please Select Employee To Update Schedule:", view=employee_schedule_paginator)
+    await send_view(interaction, "Please Select Employee To Update Schedule:", employee_schedule_paginator)
+
+
+@bot.tree.command(name="reload-routes", description="Reload the message routing table from config", guild=bot_handler.guild)
+async def reload_routes(interaction: discord.Interaction):
+    if interaction.user.id not in message_router.table.admin_user_ids:
+        await interaction.response.send_message("Error: Only admins can reload routes.", ephemeral=True)
+        return
+
+    table = message_router.reload()
+    await interaction.response.send_message(f"Reloaded routes: {len(table.admin_user_ids)} admin users, {len(table.ingest_channel_ids)} history channels, {len(table.ignored_channel_ids)} ignored channels.", ephemeral=True)
+
+
+@bot.tree.command(name="profile", description="Profile the bot for a few seconds and upload the collapsed stacks", guild=bot_handler.guild)
+@app_commands.describe(seconds="How long to sample for, at most 60")
+async def profile(interaction: discord.Interaction, seconds: int = 10):
+    if interaction.user.id not in message_router.table.admin_user_ids:
+        await interaction.response.send_message("Error: Only admins can profile the bot.", ephemeral=True)
+        return
+
+    seconds = max(1, min(seconds, 60))
+    await interaction.response.defer(ephemeral=True, thinking=True)
+    path = await profile_to_file(seconds)
+    try:
+        await interaction.followup.send(f"Sampled {seconds}s of stacks, open with speedscope or flamegraph.pl.", file=discord.File(path), ephemeral=True)
+    finally:
+        os.remove(path)
 
 @bot.event
 async def on_message(message):
-    print(f'Message from {message.author} via Channel {message.channel}: {message.content}')
-    # Check if the bot or johanson was mentioned
+    MESSAGES_SEEN.inc()
+    # Every replica sees every message, only the one owning the channel answers
+    if not coordinator.owns(message.channel.id):
+        return
+    route = message_router.route(message, bot.user)
+    if route == ROUTE_IGNORE or route == ROUTE_INGEST:
+        # History channels are picked up by the scheduled sweep
+        await bot.process_commands(message)
+        return
+
+    # Every span recorded while handling this message is keyed by its id
+    with tracer.trace(message.id):
+        await handle_message(message, route)
+
+
+async def handle_message(message, route):
+    print(f'Message from {message.author} via Channel {message.channel} routed to {route}')
 
     # Get all members who can view the channel
     # members_with_access = [member for member in channel.guild.members
@@ -74,30 +222,32 @@ async def on_message(message):
     # channel = discord.utils.get(message.guild.text_channels, name=message.channel.name)
     # viewers = [member for member in message.guild.members if channel.permissions_for(member).read_messages]
     # print(f'Viewers: {viewers}')
-    admin_bot_channel = bot.get_channel(int(os.getenv("ADMIN_BOT_DISCORD_CHANNEL_ID")))
-
-    if admin_bot_channel.name == message.channel.name or (bot.user in message.mentions and message.author.id == '405840051113558026'):
+    if route == ROUTE_ADMIN_AGENT:
+        # Admin mentions outside the admin channel are answered in place when no admin channel is configured
+        admin_bot_channel = bot.get_channel(message_router.table.admin_channel_id or message.channel.id)
         # Process the message with the AI agent
         channel_id = str(message.channel.id)
         channel_name = str(message.channel.name)
         print(f'Processing message from {message.author} via Channel {message.channel}: {message.content}')
-        response = await agent.process_message(message.content, channel_id, channel_name, SYSTEM_PROMPT)
+        response = await run_agent("task_agent", message_content=message.content, channel_id=channel_id, channel_name=channel_name, prompt=SYSTEM_PROMPT)
         print(f'Response: {response}')
         # Send the agent's response
 
-        await admin_bot_channel.send(response)
+        await send_message(admin_bot_channel, response)
 
-    if bot.user in message.mentions:
-        # Process the message with the AI agent
-        channel_id = str(message.channel.id)
-        channel_name = str(message.channel.name)
-        print(f'Processing message from {message.author} via Channel {message.channel}: {message.content}')
-        response = await user_request_agent.process_message(message.content, channel_id, channel_name, message.author.id, message.author.name)
-        print(f'Response: {response}')
-        # Send the agent's response
+    if route == ROUTE_MENTION_AGENT:
+        # Show the typing indicator for the whole time the answer is being worked on
+        async with message.channel.typing():
+            # Process the message with the AI agent
+            channel_id = str(message.channel.id)
+            channel_name = str(message.channel.name)
+            print(f'Processing message from {message.author} via Channel {message.channel}: {message.content}')
+            response = await run_agent("user_request_agent", message_content=message.content, channel_id=channel_id, channel_name=channel_name, user_discord_id=message.author.id, user_name=message.author.name)
+            print(f'Response: {response}')
+            # Send the agent's response
 
-        target_channel = bot.get_channel(message.channel.id)
-        await target_channel.send(response)
+            target_channel = bot.get_channel(message.channel.id)
+            await send_message(target_channel, response)
 
     # Process commands
     await bot.process_commands(message)
@@ -106,22 +256,36 @@ async def on_message(message):
 @tasks.loop(reconnect=True, hours=24)
 async def scheduled_reminder_check():
     """Check for reminders that need to be sent"""
+    await coordinator.start()
+    if not coordinator.is_leader:
+        print(f"Skipping reminder check, replica {coordinator.replica_id} is not the scheduler leader")
+        return
     print("Checking for reminders that need to be sent")
 
     try:
-        # Get all tasks from the database
-        tasks = get_tasks()
-
-        # Check if any tasks need to be sent
-        for task in tasks:
-            if task['due_date'] <= datetime.datetime.now():
-                # Use specified channel
-                target_channel = bot.get_channel(task['channel_id'])
-                target_channel.send(f"Reminder for {task['name']}. \n Description: {task['description']}")
-                
-                if task['reminder_frequency'] == 'ONCE':
-                    # Delete the task from the database
-                    delete_task(task['_id'])
+        # Only the tasks that are due, instead of every task in the database
+        tasks = await run_db(query_tasks, TaskQuery(due_before=datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), limit=None), raw=True, operation="query_tasks")
+
+        # One-off tasks are deleted together once their reminders are out
+        finished_task_ids = []
+        try:
+            # Check if any tasks need to be sent
+            for task in tasks:
+                if task['due_date'] <= datetime.datetime.now():
+                    # Use specified channel
+                    target_channel = bot.get_channel(task['channel_id'])
+                    await send_message(target_channel, f"Reminder for {task['name']}. \n Description: {task['description']}")
+                    REMINDERS_SENT.inc()
+
+                    if task['reminder_frequency'] == 'ONCE':
+                        finished_task_ids.append(task['_id'])
+        finally:
+            # Delete the tasks from the database
+            await delete_tasks(finished_task_ids)
+            if agent_executor is None:
+                # In process mode the workers' indexes reload from the database instead
+                for task_id in finished_task_ids:
+                    get_task_dedup_index().remove(task_id)
         
     except Exception as e:
         print(f"Error: {e}")
@@ -130,65 +294,110 @@ async def scheduled_reminder_check():
 # This function will run in the background
 @tasks.loop(reconnect=True, hours=24)
 async def scheduled_history_timeframe(days_ago=5, limit=500):
-    """Get message history within a specific timeframe"""
-    print("Getting message history within a specific timeframe")
+    """Get message history within a specific timeframe for every history channel this replica owns"""
+    await coordinator.start()
+
+    # Finish windows an interrupted sweep left behind before starting a new one
+    for job in get_job_store().unfinished("ingest_window"):
+        # Windows stored here are only known here, so they are finished here even if their channel moved
+        print(f"Resuming ingest window {job['key'][:12]} (attempt {job['attempts'] + 1})")
+        await process_ingest_window(job["key"], job["payload"])
+
+    for channel_id in sorted(message_router.table.ingest_channel_ids):
+        if coordinator.owns(channel_id):
+            await ingest_channel_history(channel_id, days_ago, limit)
+
+
+async def process_ingest_window(key, payload):
+    """Run the ingestor on a stored window and post the task it created"""
+    job_store = get_job_store()
+    job_store.start(key)
+    try:
+        with tracer.trace(f"sweep-{payload['channel_id']}-{payload['first_message_id']}"):
+            response = await run_agent("ingestor", message_content=payload["message_content"], channel_id=payload["channel_id"], channel_name=payload["channel_name"], idempotency_key=key)
+    except Exception as e:
+        print(f"Error ingesting window {key[:12]}: {e}")
+        job_store.fail(key, str(e))
+        return
+    job_store.finish(key, response)
+    print(f"Response: {response}")
+
+    try:
+        task_channel_id = 1361986399259332738
+        if not response:
+            return
+        payload = json.loads(response)
+        task_name = payload['task_name']
+        description = payload['description']
+        assignee_name = payload['assignee_name']
+        next_reminder = payload['next_reminder']
+        await send_message(bot.get_channel(task_channel_id), f"**Successfully created task**\n\n**Task Name:** {task_name}\n**Description:** {description}\n**Assignee:** {assignee_name}\n**Next Reminder:** {next_reminder}")
+    except Exception as e:
+        print(f'Error sending task to channel: {e}')
+
+
+async def ingest_channel_history(channel_id, days_ago=5, limit=500):
+    """Get message history of a channel within a specific timeframe"""
+    print(f"Getting message history of {channel_id} within a specific timeframe")
 
     try:
         # Calculate the date for days_ago
         start_date = datetime.datetime.now() - datetime.timedelta(days=days_ago)
-        channel_id = 1264079091154423948
 
         # Use specified channel
         target_channel = bot.get_channel(channel_id)
 
-        messages = []
-        async for message in target_channel.history(limit=limit, after=start_date):
-            messages.append({
-                "channel": target_channel.name,
-                "message": message.content,
-                "author": message.author.name,
-                "created_at": message.created_at,
-                "user_mentions": [mention.name for mention in message.mentions]
-            })
-
-        if not messages:
-            await target_channel.send(f"No messages found in the last {days_ago} days.")
-            return
-        
         # log_discord_chat_history(messages)
 
-        employees = get_employees()
-        employees_string = "\n".join([f"Employee name: {employee['name']} - Discord ID: {employee['discord_id']} - Discord Username: {employee['discord_username']}" for employee in employees])
-        # messages_string = "\n".join([f"{message['author']} said: '{' and '.join([mention for mention in message['user_mentions']])}{message['message']}' " for message in messages])
-        # messages_string = remove_angle_bracket_content(messages_string)
-
-        iterator = 0
-        message_batch = ""
-        for message in messages:
-            print(f"iterator: {iterator}")
-            if iterator < 2:
-                message_batch += f"{message['author']} said: '{' and '.join([mention for mention in message['user_mentions']])} {message['message']} \n"
-                iterator += 1
-                continue
-            
-            try:
-                full_messages = f"EMPLOYEES: {employees_string}\n\n MESSAGES: \n{remove_angle_bracket_content(message_batch)}"
-                response = await discord_chat_history_ingestor.process_message(full_messages, channel_id, target_channel.name)
-                print(f"Response: {response}")
-                task_channel_id = 1361986399259332738
-                if not response:
-                    continue
-                payload = json.loads(response)
-                task_name = payload['task_name']
-                description = payload['description']
-                assignee_name = payload['assignee_name']
-                next_reminder = payload['next_reminder']
-                await bot.get_channel(task_channel_id).send(f"**Successfully created task**\n\n**Task Name:** {task_name}\n**Description:** {description}\n**Assignee:** {assignee_name}\n**Next Reminder:** {next_reminder}")
-            except Exception as e:
-                print(f'Error sending task to channel: {e}')
-            finally:
-                message_batch = message_batch.split('\n')[-1] # Get the last message for overlapping messages
-                iterator = 0
+        employees = await employee_roster.get()
+        employee_lines = [f"Employee name: {employee['name']} - Discord ID: {employee['discord_id']} - Discord Username: {employee['discord_username']}" for employee in employees]
+        # The ingestor's user message holds the roster and one window, it is cut from the end when
+        # over budget, so the two are budgeted here and the window gets what the roster leaves
+        budget = ingestor_budgeter.budget
+        room = budget.user_message - INGEST_PROMPT_OVERHEAD_TOKENS
+        roster_usage = ingestor_budgeter.new_prompt()
+        roster_lines = roster_usage.lines("roster", employee_lines, max_tokens=min(budget.roster, room - MIN_WINDOW_TOKENS))
+        if roster_usage.trimmed:
+            print(f"Roster trimmed to {roster_usage.tokens['roster']} tokens, {len(employee_lines) - len(roster_lines)} employees did not fit")
+        employees_string = "\n".join(roster_lines)
+        window_tokens = min(WINDOW_TOKENS, room - roster_usage.tokens["roster"])
+        if window_tokens < WINDOW_TOKENS:
+            print(f"History windows cut to {window_tokens} tokens to fit next to the roster")
+
+        # Resume after the newest message already stored in a window, window boundaries shift
+        # from one sweep to the next so the windows themselves can't tell what was ingested
+        job_store = get_job_store()
+        mark_name = f"ingest:{channel_id}"
+        last_message_id = job_store.high_water_mark(mark_name)
+        after_id = max(last_message_id or 0, discord.utils.time_snowflake(start_date))
+
+        # Windows are built while history pages are still being fetched
+        chat_lines = iter_chat_lines(target_channel.history(limit=limit, after=discord.Object(id=after_id)), target_channel.name)
+        window_count = 0
+        async for window in prefetch(iter_windows(chat_lines, max_tokens=window_tokens)):
+            window_count += 1
+            print(f"window: {window_count} ({len(window.lines)} lines, {window.tokens} tokens)")
+
+            # A window whose mark update was lost is not stored twice
+            key = make_idempotency_key("ingest", channel_id, *window.message_ids)
+            payload = {
+                "message_content": f"EMPLOYEES: {employees_string}\n\n MESSAGES: \n{window.text}",
+                "channel_id": channel_id,
+                "channel_name": target_channel.name,
+                "first_message_id": window.message_ids[0],
+            }
+            enqueued = job_store.enqueue("ingest_window", key, payload)
+            # The window is in the job store now, a failed run is retried from there by the next sweep
+            job_store.advance_high_water_mark(mark_name, window.message_ids[-1])
+            if enqueued:
+                await process_ingest_window(key, payload)
+
+        if not window_count:
+            if last_message_id is None:
+                await send_message(target_channel, f"No messages found in the last {days_ago} days.")
+            else:
+                print(f"No new messages in {channel_id} since {last_message_id}")
+            return
 
 
         # for message in messages_string.split('\n'):
@@ -223,19 +432,45 @@ async def before_scheduled_history():
     await bot.wait_until_ready()
     print("Starting scheduled history capture...")
 
+
+# Reminders are sent to channels, so the bot must be connected first
+@scheduled_reminder_check.before_loop
+async def before_scheduled_reminders():
+    await bot.wait_until_ready()
+    print("Starting scheduled reminder check...")
+
     
 if __name__ == "__main__":
     async def main():
-        try:
-            # Start the scheduled task
-            scheduled_history_timeframe.start()
-            # Run the bot
-            await bot.start(TOKEN)
-        except Exception as e:
-            print(f"Error in main loop: {e}")
-            # Wait a bit before retrying
-            await asyncio.sleep(5)
-            await main()  # Retry
+        while True:
+            try:
+                # Logs the stack of anything that blocks the event loop
+                watchdog.start()
+                # Join the other replicas before the first message arrives
+                await coordinator.start()
+                if agent_executor is not None and not agent_executor.running:
+                    agent_executor.start(asyncio.get_running_loop())
+                # Start the scheduled tasks, unfinished windows are resumed from the job store
+                if not scheduled_history_timeframe.is_running():
+                    scheduled_history_timeframe.start()
+                # Every replica runs the loop, only the scheduler leader sends the reminders
+                if REMINDERS_ENABLED and not scheduled_reminder_check.is_running():
+                    scheduled_reminder_check.start()
+                # Run the bot
+                await bot.start(TOKEN)
+                return
+            except Exception as e:
+                print(f"Error in main loop: {e}")
+                # Wait a bit before retrying
+                await asyncio.sleep(5)
+
+    if os.getenv("AGENT_EXECUTION_MODE", "inline") == "process":
+        # Messages the agents post, eg. the created task, are sent from here with the job result
+        agent_executor = AgentExecutor(notify=lambda channel_id, content: send_message(bot.get_channel(channel_id), content))
+
+    # Serve /metrics for the lifetime of the process
+    start_metrics_server()
+    count_discord_rate_limits()
 
     # Run the async main function
     asyncio.run(main())
@@ -0,0 +1,69 @@
+import os
+from typing import FrozenSet, Optional
+from dotenv import load_dotenv
+from pydantic import BaseModel, Field
+
+# Trigger types a message can be routed to
+ROUTE_IGNORE = "ignore"
+ROUTE_ADMIN_AGENT = "admin_agent"
+ROUTE_MENTION_AGENT = "mention_agent"
+ROUTE_INGEST = "ingest"
+
+DEFAULT_ADMIN_USER_IDS = "405840051113558026"
+DEFAULT_HISTORY_CHANNEL_IDS = "1264079091154423948"
+
+
+def _parse_ids(value: Optional[str]) -> FrozenSet[int]:
+    return frozenset(int(part) for part in (value or "").split(",") if part.strip())
+
+
+class RouteTable(BaseModel):
+    """Channel and user ids on_message reacts to, built once from the environment"""
+    admin_channel_id: Optional[int] = Field(None, description="Channel whose messages go to the task management agent")
+    admin_user_ids: FrozenSet[int] = Field(default_factory=frozenset, description="Users whose mentions go to the task management agent")
+    ingest_channel_ids: FrozenSet[int] = Field(default_factory=frozenset, description="Channels swept by the history ingestor")
+    ignored_channel_ids: FrozenSet[int] = Field(default_factory=frozenset, description="Channels the bot never answers in")
+
+
+def load_route_table() -> RouteTable:
+    """Build the route table from ADMIN_BOT_DISCORD_CHANNEL_ID, ADMIN_USER_IDS, HISTORY_CHANNEL_IDS and IGNORED_CHANNEL_IDS"""
+    admin_channel_id = os.getenv("ADMIN_BOT_DISCORD_CHANNEL_ID")
+    return RouteTable(
+        admin_channel_id=int(admin_channel_id) if admin_channel_id else None,
+        admin_user_ids=_parse_ids(os.getenv("ADMIN_USER_IDS", DEFAULT_ADMIN_USER_IDS)),
+        ingest_channel_ids=_parse_ids(os.getenv("HISTORY_CHANNEL_IDS", DEFAULT_HISTORY_CHANNEL_IDS)),
+        ignored_channel_ids=_parse_ids(os.getenv("IGNORED_CHANNEL_IDS")),
+    )
+
+
+class MessageRouter:
+    """Decides which agent, if any, handles a message using only set lookups"""
+
+    def __init__(self, table: Optional[RouteTable] = None):
+        self.table = table or load_route_table()
+
+    def reload(self) -> RouteTable:
+        """Re-read the .env file and rebuild the route table without restarting the bot"""
+        load_dotenv(override=True)
+        self.table = load_route_table()
+        return self.table
+
+    def route(self, message, bot_user) -> str:
+        table = self.table
+        author_id = message.author.id
+        channel_id = message.channel.id
+
+        # Never answer our own messages, the admin channel would otherwise loop forever
+        if bot_user is not None and author_id == bot_user.id:
+            return ROUTE_IGNORE
+        if channel_id in table.ignored_channel_ids:
+            return ROUTE_IGNORE
+
+        mentioned = bot_user is not None and bot_user in message.mentions
+        if channel_id == table.admin_channel_id or (mentioned and author_id in table.admin_user_ids):
+            return ROUTE_ADMIN_AGENT
+        if mentioned:
+            return ROUTE_MENTION_AGENT
+        if channel_id in table.ingest_channel_ids:
+            return ROUTE_INGEST
+        return ROUTE_IGNORE
@@ -0,0 +1,225 @@
+import os
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def _label_key(labels: Dict[str, str]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(key: Tuple[Tuple[str, str], ...], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    """Monotonically increasing value, optionally split by labels"""
+    kind = "counter"
+
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: Dict[tuple, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels) if labels else ()
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self.lock:
+            return [f"{self.name}{_format_labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+    kind = "gauge"
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        key = _label_key(labels) if labels else ()
+        with self.lock:
+            self.values[key] = value
+
+
+class Histogram:
+    """Distribution of observed values in cumulative buckets"""
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.values: Dict[tuple, List[float]] = {}  # bucket counts followed by sum and count
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels) if labels else ()
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> List[str]:
+        lines = []
+        with self.lock:
+            for key, series in self.values.items():
+                cumulative = 0
+                for bucket, count in zip(self.buckets, series):
+                    cumulative += count
+                    lines.append(f"{self.name}_bucket{_format_labels(key, ('le', str(bucket)))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {series[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {series[-2]}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Holds every metric of the bot process and renders them in the Prometheus text format"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def counter(self, name: str, description: str) -> Counter:
+        return self.metrics.setdefault(name, Counter(name, description))
+
+    def gauge(self, name: str, description: str) -> Gauge:
+        return self.metrics.setdefault(name, Gauge(name, description))
+
+    def histogram(self, name: str, description: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self.metrics.setdefault(name, Histogram(name, description, buckets))
+
+    def export(self) -> Dict[str, Dict[tuple, Any]]:
+        """Copy of every counter and histogram value, gauges are only meaningful in their own process"""
+        values = {}
+        for metric in list(self.metrics.values()):
+            if metric.kind == "gauge":
+                continue
+            with metric.lock:
+                values[metric.name] = {key: list(value) if isinstance(value, list) else value for key, value in metric.values.items()}
+        return values
+
+    def delta(self, before: Dict[str, Dict[tuple, Any]]) -> List[Dict[str, Any]]:
+        """What counters and histograms gained since export() returned before, as JSON friendly dicts"""
+        deltas = []
+        for name, series in self.export().items():
+            metric = self.metrics[name]
+            previous = before.get(name, {})
+            changes = []
+            for key, value in series.items():
+                old = previous.get(key)
+                if metric.kind == "histogram":
+                    change = [count - (old[index] if old else 0) for index, count in enumerate(value)]
+                    if change[-1]:
+                        changes.append([[list(pair) for pair in key], change])
+                elif value - (old or 0):
+                    changes.append([[list(pair) for pair in key], value - (old or 0)])
+            if changes:
+                deltas.append({
+                    "name": name,
+                    "kind": metric.kind,
+                    "description": metric.description,
+                    "buckets": list(metric.buckets) if metric.kind == "histogram" else None,
+                    "values": changes,
+                })
+        return deltas
+
+    def merge(self, deltas: List[Dict[str, Any]]):
+        """Add the deltas recorded by another process, eg. an agent worker"""
+        for delta in deltas:
+            if delta["kind"] == "histogram":
+                metric = self.histogram(delta["name"], delta["description"], tuple(delta["buckets"]))
+            else:
+                metric = self.counter(delta["name"], delta["description"])
+            for key, change in delta["values"]:
+                key = tuple(tuple(pair) for pair in key)
+                with metric.lock:
+                    if delta["kind"] == "histogram":
+                        series = metric.values.setdefault(key, [0] * len(change))
+                        for index, count in enumerate(change):
+                            series[index] += count
+                    else:
+                        metric.values[key] = metric.values.get(key, 0) + change
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+MESSAGES_SEEN = registry.counter("discord_messages_seen_total", "Messages seen by on_message")
+AGENT_RUNS = registry.counter("agent_runs_total", "Agent runs by agent")
+AGENT_RUNS_IN_PROGRESS = registry.gauge("agent_runs_in_progress", "Agent runs currently waiting or executing")
+AGENT_RUN_SECONDS = registry.histogram("agent_run_seconds", "Agent run latency by agent")
+LLM_CALLS = registry.counter("llm_calls_total", "LLM calls by model and source (message or sweep)")
+LLM_TOKENS = registry.counter("llm_tokens_total", "LLM tokens by model and kind (prompt or completion)")
+LLM_JSON_RETRIES = registry.counter("llm_json_retries_total", "LLM calls retried because of errors or unparseable JSON")
+LLM_SECONDS = registry.histogram("llm_call_seconds", "LLM call latency by model")
+TOOL_CALLS = registry.counter("tool_calls_total", "Tool calls by tool")
+TASKS_CREATED = registry.counter("tasks_created_total", "Tasks created through create_task_tool")
+REMINDERS_SENT = registry.counter("reminders_sent_total", "Task reminders sent")
+DISCORD_RATE_LIMITED = registry.counter("discord_rate_limited_total", "Discord API responses with status 429")
+
+
+class _RateLimitLogHandler(logging.Handler):
+    """Counts the rate limit warnings discord.py logs when it retries a 429 internally"""
+
+    def emit(self, record: logging.LogRecord):
+        if "rate limited" in record.getMessage():
+            DISCORD_RATE_LIMITED.inc()
+
+
+def count_discord_rate_limits():
+    """Count 429s that discord.py handles without raising"""
+    logging.getLogger("discord.http").addHandler(_RateLimitLogHandler(level=logging.WARNING))
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are too frequent to print
+        pass
+
+
+def start_metrics_server(port: Optional[int] = None, host: Optional[str] = None) -> Optional[ThreadingHTTPServer]:
+    """Serve /metrics from a daemon thread, METRICS_PORT=0 disables it"""
+    port = int(os.getenv("METRICS_PORT", 9464)) if port is None else port
+    host = host or os.getenv("METRICS_HOST", "127.0.0.1")
+    if not port:
+        return None
+
+    server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,139 @@
+import os
+import json
+from typing import Dict, Optional
+from pydantic import BaseModel, Field
+from langchain_ollama import ChatOllama
+from tracing import tracer, record_llm_usage, current_trace_id
+from metrics import LLM_CALLS, LLM_TOKENS, LLM_JSON_RETRIES, LLM_SECONDS
+from llm_cache import CachedChatModel, CacheMiss, wrap_with_cache
+from token_budget import MODEL_CONTEXT_TOKENS
+
+# Steps that only need a cheap yes/no style decision go to the small model,
+# everything that needs accurate parameters or a conversational answer goes to the large one
+SMALL_MODEL_STEPS = {"classify"}
+LARGE_MODEL_STEPS = {"extract", "respond"}
+
+
+class RouteConfig(BaseModel):
+    """Routing settings for a single agent"""
+    small_model: str = Field("llama3.2:1b", description="Model used for classification steps")
+    large_model: str = Field("llama3.1", description="Model used for extraction and conversational steps")
+    enabled: bool = Field(True, description="When false every step goes to the large model")
+    max_small_prompt_chars: int = Field(12000, description="Prompts longer than this skip the small model")
+
+
+def load_route_config(agent_name: str) -> RouteConfig:
+    """Load the routing settings for an agent from the environment, eg. INGESTOR_SMALL_MODEL"""
+    prefix = agent_name.upper()
+    defaults = RouteConfig()
+    return RouteConfig(
+        small_model=os.getenv(f"{prefix}_SMALL_MODEL", os.getenv("SMALL_MODEL", defaults.small_model)),
+        large_model=os.getenv(f"{prefix}_LARGE_MODEL", os.getenv("LARGE_MODEL", defaults.large_model)),
+        enabled=os.getenv(f"{prefix}_MODEL_ROUTING", os.getenv("MODEL_ROUTING", "1")) not in ("0", "false", "False"),
+        max_small_prompt_chars=int(os.getenv(f"{prefix}_MAX_SMALL_PROMPT_CHARS", defaults.max_small_prompt_chars)),
+    )
+
+
+def create_chat_model(model_name: str) -> ChatOllama:
+    return wrap_with_cache(ChatOllama(model=model_name, temperature=0, num_ctx=MODEL_CONTEXT_TOKENS))
+
+
+class ModelRouter:
+    """Hands out the chat model to use for a given step of an agent"""
+
+    # Replaced by the benchmarks with a stub chat model
+    model_factory = staticmethod(create_chat_model)
+
+    def __init__(self, agent_name: str, config: Optional[RouteConfig] = None):
+        self.agent_name = agent_name
+        self.config = config or load_route_config(agent_name)
+        self.models: Dict[str, ChatOllama] = {}
+        self.prefill_models: Dict[str, ChatOllama] = {}
+
+    def _get_model(self, model_name: str) -> ChatOllama:
+        if model_name not in self.models:
+            self.models[model_name] = self.model_factory(model_name)
+        return self.models[model_name]
+
+    def model_name_for(self, step: str, prompt: str = "") -> str:
+        """Return the model name a step should run on"""
+        if step not in SMALL_MODEL_STEPS and step not in LARGE_MODEL_STEPS:
+            raise ValueError(f"Unknown model step {step}")
+
+        if not self.config.enabled or step in LARGE_MODEL_STEPS:
+            return self.config.large_model
+        if len(prompt) > self.config.max_small_prompt_chars:
+            return self.config.large_model
+        return self.config.small_model
+
+    def for_step(self, step: str, prompt: str = "") -> ChatOllama:
+        """Return the chat model a step should run on"""
+        return self._get_model(self.model_name_for(step, prompt))
+
+    def prefill(self, step: str, prefix: str):
+        """Load a step's model and have it process a prompt prefix, so a following call sharing the prefix only prefills the rest
+
+        Ollama keeps the KV cache of the last prompt, the real call reuses it for the common prefix.
+        Only a single token is generated. Models that aren't ChatOllama (eg. the benchmark stub) are skipped.
+        """
+        llm = self.for_step(step)
+        llm = llm.llm if isinstance(llm, CachedChatModel) else llm
+        if not isinstance(llm, ChatOllama):
+            return
+        if llm.model not in self.prefill_models:
+            self.prefill_models[llm.model] = llm.model_copy(update={"num_predict": 1})
+        try:
+            with tracer.span("prefill", model=llm.model):
+                self.prefill_models[llm.model].invoke(prefix)
+        except Exception as e:
+            print(f"Error prefilling {llm.model}: {e}")
+
+    def should_escalate(self, step: str, prompt: str, response_content: str) -> bool:
+        """Check if a classification answered by the small model needs a second pass on the large model"""
+        if self.model_name_for(step, prompt) == self.config.large_model:
+            return False
+        try:
+            return bool(json.loads(response_content).get("tools_needed"))
+        except Exception:
+            return True
+
+
+def invoke_llm(llm: ChatOllama, prompt, parse_json: bool = False):
+    """Invoke a model, retrying until it succeeds (and returns parseable JSON when parse_json is set)"""
+    with tracer.span("llm", model=getattr(llm, "model", None)) as span:
+        retries = 0
+        while True:
+            try:
+                response = llm.invoke(prompt)
+                if parse_json:
+                    json.loads(response.content)
+                break
+            except CacheMiss:
+                raise
+            except Exception as e:
+                if isinstance(llm, CachedChatModel):
+                    # Don't keep replaying a bad completion
+                    llm.discard(prompt)
+                print(f"Error invoking {getattr(llm, 'model', 'LLM')}: {e}")
+                retries += 1
+                continue
+
+        span["retries"] = retries
+        record_llm_usage(span, response)
+
+    model = span["model"]
+    source = "sweep" if (current_trace_id.get() or "").startswith("sweep-") else "message"
+    LLM_CALLS.inc(model=model, source=source)
+    LLM_SECONDS.observe(span["duration_ms"] / 1000, model=model)
+    if retries:
+        LLM_JSON_RETRIES.inc(retries, model=model)
+    if span["prompt_tokens"]:
+        LLM_TOKENS.inc(span["prompt_tokens"], model=model, kind="prompt")
+    if span["completion_tokens"]:
+        LLM_TOKENS.inc(span["completion_tokens"], model=model, kind="completion")
+    return response
+
+
+def invoke_json(llm: ChatOllama, prompt):
+    """Invoke a model until it returns parseable JSON"""
+    return invoke_llm(llm, prompt, parse_json=True)
@@ -33,6 +33,8 @@ class AgentState(TypedDict):
     channel_name: str
     discord_bot: commands.Bot
     prompt: str
+    idempotency_key: Optional[str]  # Source of the run, tool side effects are committed once per key
+    notifications: List[Dict[str, Any]]  # Channel messages to post once the run is done
 
 class UserRequestState(TypedDict):
     input: HumanMessage
@@ -40,6 +42,7 @@ class UserRequestState(TypedDict):
     discord_bot: commands.Bot
     channel_id: str
     channel_name: str
+    retrieved: Optional[List[Dict[str, Any]]]  # Vector DB results fetched before the graph runs
 
 class DiscordChatHistoryIngestorState(TypedDict):
     input: HumanMessage
@@ -49,7 +52,43 @@ class DiscordChatHistoryIngestorState(TypedDict):
     current_tool_calls: List[Dict[str, Any]]  # Tool name and inputs
     channel_name: str
 
+# Filters for a task lookup, shared by query_tasks_tool and the reminder check
+class TaskQuery(BaseModel):
+    assignee_name: Optional[str] = Field(None, description="Only tasks assigned to this employee")
+    status: Optional[str] = Field(None, description="Only tasks with this status, eg. OPEN or DONE")
+    priority: Optional[str] = Field(None, description="Only tasks with this priority: LOW, MEDIUM, HIGH, or URGENT")
+    channel_id: Optional[str] = Field(None, description="Only tasks created from this Discord channel")
+    due_after: Optional[str] = Field(None, description="Only tasks due after this date, YYYY-MM-DD HH:MM format")
+    due_before: Optional[str] = Field(None, description="Only tasks due before this date, YYYY-MM-DD HH:MM format")
+    fields: Optional[List[str]] = Field(None, description="Task fields to return, eg. ['name', 'due_date'], default is a short summary")
+    limit: Optional[int] = Field(10, description="Maximum number of tasks to return")
+
 # Create a custom tool invocation structure as replacement for ToolInvocation
 class ToolCall(BaseModel):
     tool: str
-    tool_input: Dict[str, Any]
\ No newline at end of file
+    tool_input: Dict[str, Any]
+
+
+# A normalized Discord message as fed to the history ingestor
+class ChatLine(BaseModel):
+    message_id: int
+    channel: str
+    author: str
+    content: str
+    created_at: datetime.datetime
+    user_mentions: List[str] = Field(default_factory=list)
+    text: str = Field('', description="The rendered line sent to the LLM")
+    tokens: int = 0
+
+# A group of chat lines processed by one ingestor run
+class ChatWindow(BaseModel):
+    lines: List[ChatLine]
+    tokens: int
+
+    @property
+    def text(self) -> str:
+        return "".join(line.text for line in self.lines)
+
+    @property
+    def message_ids(self) -> List[int]:
+        return sorted({line.message_id for line in self.lines})
\ No newline at end of file
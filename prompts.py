@@ -107,7 +107,16 @@ TOOLS = """
 - update_employee_tool [updates an employee in the database by name]
 - log_employee_tool [logs an employee to the database]
 - log_employee_schedule_tool [logs an employee schedule to the database]
-- get_task_tool [gets all tasks and their information from the database]
+- get_task_tool [gets all tasks and their information from the database, only use it when every task is really needed]
+- query_tasks_tool [finds the tasks matching filters, prefer this over get_task_tool]
+   - assignee_name (optional) [str]: Only tasks assigned to this employee
+   - status (optional) [str]: Only tasks with this status
+   - priority (optional) [str]: Only tasks with this priority (low, medium, high, urgent)
+   - channel_id (optional) [str]: Only tasks created from this channel
+   - due_after (optional) [str]: Only tasks due after this date (YYYY-MM-DD HH:MM)
+   - due_before (optional) [str]: Only tasks due before this date (YYYY-MM-DD HH:MM)
+   - fields (optional) [list]: The task fields to return (default: id, name, description, assignee, status, priority, due date)
+   - limit (optional) [int]: The maximum number of tasks to return (default: 10, at most 50)
 """
 
 _CREATE_TASK_PROMPT = f"""
@@ -0,0 +1,95 @@
+import os
+import time
+import asyncio
+from typing import Any, Callable, Dict, List, Optional
+
+from metrics import registry
+from db_pool import run_db
+
+CACHE_LOOKUPS = registry.counter("roster_cache_lookups_total", "Cached dataset reads by dataset and result (hit, stale, miss)")
+
+# Slash commands have 3 seconds to respond, past this they defer and follow up instead
+INTERACTION_DEFER_AFTER = float(os.getenv("INTERACTION_DEFER_AFTER", 2.0))
+
+
+class CachedDataset:
+    """A slowly changing list from the database, shared by its readers and refreshed in the background"""
+
+    def __init__(self, name: str, loader: Callable[[], List[Dict[str, Any]]], sort_key: Callable[[Dict[str, Any]], str], ttl: Optional[float] = None):
+        self.name = name
+        self.loader = loader
+        self.sort_key = sort_key
+        self.ttl = float(os.getenv("ROSTER_CACHE_TTL_SECONDS", 300)) if ttl is None else ttl
+        self.items: Optional[List[Dict[str, Any]]] = None
+        self.loaded_at = 0.0
+        self.refresh_task: Optional[asyncio.Task] = None
+
+    @property
+    def is_warm(self) -> bool:
+        return self.items is not None
+
+    @property
+    def is_stale(self) -> bool:
+        return time.time() - self.loaded_at > self.ttl
+
+    async def _load(self):
+        started = time.perf_counter()
+        items = await run_db(self.loader, operation=f"load_{self.name}")
+        items = sorted(items, key=self.sort_key)
+        self.items, self.loaded_at = items, time.time()
+        print(f"Loaded {len(items)} {self.name} in {time.perf_counter() - started:.2f}s")
+
+    async def refresh(self):
+        """Reload from the database, concurrent callers share one load"""
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self._load())
+        await asyncio.shield(self.refresh_task)
+
+    def refresh_in_background(self):
+        if self.refresh_task is None or self.refresh_task.done():
+            self.refresh_task = asyncio.create_task(self._load())
+            self.refresh_task.add_done_callback(self._log_refresh_error)
+
+    def _log_refresh_error(self, task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            print(f"Error refreshing {self.name}: {task.exception()}")
+
+    async def get(self) -> List[Dict[str, Any]]:
+        """All items, serving a stale copy while a fresh one loads"""
+        if not self.is_warm:
+            CACHE_LOOKUPS.inc(dataset=self.name, result="miss")
+            await self.refresh()
+        elif self.is_stale:
+            CACHE_LOOKUPS.inc(dataset=self.name, result="stale")
+            self.refresh_in_background()
+        else:
+            CACHE_LOOKUPS.inc(dataset=self.name, result="hit")
+        return self.items
+
+
+async def send_view(interaction, content: str, view):
+    """Send a paginator view within the interaction deadline
+
+    The view's dropdown is filled on a thread. If filling it takes longer than
+    INTERACTION_DEFER_AFTER, the response is deferred and the view sent as a follow up.
+    """
+    fill = asyncio.ensure_future(asyncio.to_thread(view.update_dropdown))
+    done, _ = await asyncio.wait({fill}, timeout=INTERACTION_DEFER_AFTER)
+    if not done:
+        await interaction.response.defer(thinking=True)
+
+    try:
+        await fill
+    except Exception as e:
+        print(f"Error filling {type(view).__name__}: {e}")
+        if interaction.response.is_done():
+            # Replaces the "thinking..." of the deferred response
+            await interaction.followup.send("Error: Could not load the options, please try again.")
+        else:
+            await interaction.response.send_message("Error: Could not load the options, please try again.", ephemeral=True)
+        return
+
+    if interaction.response.is_done():
+        await interaction.followup.send(content, view=view)
+    else:
+        await interaction.response.send_message(content, view=view)
@@ -0,0 +1,48 @@
+import re
+import asyncio
+import hashlib
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from metrics import registry
+
+REQUESTS_COALESCED = registry.counter("agent_requests_coalesced_total", "Agent requests answered with the result of an identical request already in flight")
+
+
+def single_flight_key(*parts: Any) -> str:
+    """Key of a request, text parts are compared case and whitespace insensitive"""
+    normalized = [re.sub(r"\s+", " ", str(part)).strip().lower() for part in parts]
+    return hashlib.sha256("\x00".join(normalized).encode()).hexdigest()
+
+
+class SingleFlight:
+    """Runs one call per key at a time, callers arriving while it runs wait for its result"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.in_flight: Dict[str, asyncio.Future] = {}
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Return func's result and whether it was shared from an identical call already in flight"""
+        leader = self.in_flight.get(key)
+        if leader is not None:
+            REQUESTS_COALESCED.inc(agent=self.name)
+            # A follower giving up must not cancel the call the others are waiting on
+            return await asyncio.shield(leader), True
+
+        future = asyncio.get_running_loop().create_future()
+        self.in_flight[key] = future
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved when nobody was waiting for it
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self.in_flight[key]
@@ -0,0 +1,153 @@
+import os
+import re
+import time
+import zlib
+import random
+import threading
+from typing import Any, Dict, List, Optional, Set
+
+from src.db.db_handler import get_tasks
+from metrics import registry
+
+TASKS_DEDUPLICATED = registry.counter("tasks_deduplicated_total", "create_task_tool calls skipped as near-duplicates of an open task")
+
+NUM_PERMUTATIONS = 60
+BANDS = 20  # 20 bands of 3 rows find over 99% of pairs at 0.6 similarity and few below 0.2
+ROWS = NUM_PERMUTATIONS // BANDS
+SHINGLE_SIZE = 4
+_PRIME = (1 << 61) - 1
+CLOSED_STATUSES = {"DONE", "COMPLETED", "CLOSED", "CANCELLED"}
+
+# Worker processes each keep their own index and can't see tasks the others just created,
+# so in process mode the open tasks are reloaded for every lookup unless configured otherwise
+DEFAULT_REFRESH_SECONDS = 0 if os.getenv("AGENT_EXECUTION_MODE", "inline") == "process" else 3600
+
+# Same permutations in every process so signatures are comparable
+_random = random.Random(9530)
+_PERMUTATIONS = [(_random.randrange(1, _PRIME), _random.randrange(0, _PRIME)) for _ in range(NUM_PERMUTATIONS)]
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r"[^a-z0-9 ]+", "", re.sub(r"\s+", " ", (text or "").lower())).strip()
+
+
+def _shingles(text: str) -> Set[int]:
+    text = _normalize(text)
+    if len(text) <= SHINGLE_SIZE:
+        return {zlib.crc32(text.encode())}
+    return {zlib.crc32(text[i:i + SHINGLE_SIZE].encode()) for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def minhash(text: str) -> List[int]:
+    """MinHash signature of the character shingles of a text"""
+    shingles = _shingles(text)
+    return [min((a * shingle + b) % _PRIME for shingle in shingles) for a, b in _PERMUTATIONS]
+
+
+def similarity(signature: List[int], other: List[int]) -> float:
+    """Estimated Jaccard similarity of two signatures"""
+    return sum(1 for x, y in zip(signature, other) if x == y) / NUM_PERMUTATIONS
+
+
+class TaskDedupIndex:
+    """MinHash/LSH index over the name and description of open tasks"""
+
+    def __init__(self, threshold: Optional[float] = None, refresh_seconds: Optional[float] = None):
+        self.threshold = float(os.getenv("TASK_DEDUP_THRESHOLD", 0.6)) if threshold is None else threshold
+        self.refresh_seconds = float(os.getenv("TASK_DEDUP_REFRESH_SECONDS", DEFAULT_REFRESH_SECONDS)) if refresh_seconds is None else refresh_seconds
+        self.signatures: Dict[str, List[int]] = {}
+        self.assignees: Dict[str, str] = {}
+        self.buckets: Dict[tuple, Set[str]] = {}
+        self.loaded_at = 0.0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _text(name: str, description: str) -> str:
+        return f"{name or ''} {description or ''}"
+
+    def _band_keys(self, signature: List[int]):
+        return [(band, tuple(signature[band * ROWS:(band + 1) * ROWS])) for band in range(BANDS)]
+
+    def _add(self, task_id: str, signature: List[int], assignee: str):
+        self.signatures[task_id] = signature
+        self.assignees[task_id] = _normalize(assignee)
+        for key in self._band_keys(signature):
+            self.buckets.setdefault(key, set()).add(task_id)
+
+    def add(self, task_id: Any, name: str, description: str, assignee: str = ""):
+        signature = minhash(self._text(name, description))
+        with self.lock:
+            self._add(str(task_id), signature, assignee)
+
+    def remove(self, task_id: Any):
+        task_id = str(task_id)
+        with self.lock:
+            signature = self.signatures.pop(task_id, None)
+            self.assignees.pop(task_id, None)
+            if signature is None:
+                return
+            for key in self._band_keys(signature):
+                bucket = self.buckets.get(key)
+                if bucket:
+                    bucket.discard(task_id)
+                    if not bucket:
+                        del self.buckets[key]
+
+    def load(self, tasks: List[Dict[str, Any]]):
+        """Rebuild the index from the open tasks in the database"""
+        open_tasks = [task for task in tasks if str(task.get("status", "")).upper() not in CLOSED_STATUSES]
+        signatures = [(str(task["_id"]), minhash(self._text(task.get("name"), task.get("description"))), task.get("assignee_name") or "") for task in open_tasks]
+        with self.lock:
+            self.signatures, self.assignees, self.buckets = {}, {}, {}
+            for task_id, signature, assignee in signatures:
+                self._add(task_id, signature, assignee)
+            self.loaded_at = time.time()
+
+    def find_duplicate(self, name: str, description: str, assignee: str = "") -> Optional[str]:
+        """Return the id of an open task that is a near-duplicate, if any"""
+        if time.time() - self.loaded_at >= self.refresh_seconds:
+            self.load(get_tasks())
+
+        signature = minhash(self._text(name, description))
+        assignee = _normalize(assignee)
+        with self.lock:
+            candidates = set()
+            for key in self._band_keys(signature):
+                candidates |= self.buckets.get(key, set())
+
+            best_id, best_score = None, self.threshold
+            for task_id in candidates:
+                # Tasks for two different people aren't duplicates
+                if assignee and self.assignees[task_id] and assignee != self.assignees[task_id]:
+                    continue
+                score = similarity(signature, self.signatures[task_id])
+                if score >= best_score:
+                    best_id, best_score = task_id, score
+        return best_id
+
+
+_task_dedup_index = None
+
+
+def get_task_dedup_index() -> TaskDedupIndex:
+    global _task_dedup_index
+    if _task_dedup_index is None:
+        _task_dedup_index = TaskDedupIndex()
+    return _task_dedup_index
+
+
+def create_task_deduplicated(invoke, tool_input: Dict[str, Any]):
+    """Run create_task_tool unless an open task is a near-duplicate of the new one"""
+    index = get_task_dedup_index()
+    name, description, assignee = tool_input.get("task_name", ""), tool_input.get("description", ""), tool_input.get("assignee_name", "")
+
+    duplicate_id = index.find_duplicate(name, description, assignee)
+    if duplicate_id is not None:
+        print(f"Skipping task '{name}', near-duplicate of open task {duplicate_id}")
+        TASKS_DEDUPLICATED.inc()
+        return {"status": "skipped", "reason": "A similar open task already exists", "task_id": duplicate_id}
+
+    result = invoke()
+    task_id = (result.get("_id") or result.get("task_id")) if isinstance(result, dict) else None
+    index.add(task_id or f"new:{name}:{description}", name, description, assignee)
+    return result
@@ -0,0 +1,105 @@
+import re
+import datetime
+from typing import Any, Dict, List, Optional
+
+from models import TaskQuery
+from src.db.db_handler import get_tasks
+
+try:
+    # Runs the query in the database when db_handler supports it
+    from src.db.db_handler import find_tasks
+except ImportError:
+    find_tasks = None
+
+# What a task looks like to the agent unless it asks for specific fields
+DEFAULT_TASK_FIELDS = ["_id", "name", "description", "assignee_name", "status", "priority", "due_date"]
+
+DATE_FORMATS = ("%Y-%m-%d %H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d")
+
+
+def parse_date(value: Any) -> Optional[datetime.datetime]:
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime.datetime):
+        return value
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.datetime.strptime(str(value), date_format)
+        except ValueError:
+            continue
+    try:
+        return datetime.datetime.fromisoformat(str(value))
+    except ValueError:
+        return None
+
+
+def task_filter(query: TaskQuery) -> Dict[str, Any]:
+    """The query as a MongoDB filter document"""
+    conditions: Dict[str, Any] = {}
+    if query.assignee_name:
+        conditions["assignee_name"] = {"$regex": f"^{re.escape(query.assignee_name)}$", "$options": "i"}
+    if query.status:
+        conditions["status"] = query.status.upper()
+    if query.priority:
+        conditions["priority"] = query.priority.upper()
+    if query.channel_id:
+        conditions["channel_id"] = query.channel_id
+    due = {}
+    if parse_date(query.due_after):
+        due["$gt"] = parse_date(query.due_after)
+    if parse_date(query.due_before):
+        due["$lte"] = parse_date(query.due_before)
+    if due:
+        conditions["due_date"] = due
+    return conditions
+
+
+def matches(task: Dict[str, Any], query: TaskQuery) -> bool:
+    """Check a task against the query, used when the database can't filter"""
+    if query.assignee_name and str(task.get("assignee_name") or "").lower() != query.assignee_name.lower():
+        return False
+    if query.status and str(task.get("status") or "").upper() != query.status.upper():
+        return False
+    if query.priority and str(task.get("priority") or "").upper() != query.priority.upper():
+        return False
+    if query.channel_id and str(task.get("channel_id") or "") != str(query.channel_id):
+        return False
+    if query.due_after or query.due_before:
+        due_date = parse_date(task.get("due_date"))
+        if due_date is None:
+            return False
+        if parse_date(query.due_after) and due_date <= parse_date(query.due_after):
+            return False
+        if parse_date(query.due_before) and due_date > parse_date(query.due_before):
+            return False
+    return True
+
+
+def project(task: Dict[str, Any], fields: List[str]) -> Dict[str, Any]:
+    """Keep only the requested fields, dates and ids as strings so the result can be put in a prompt"""
+    projected = {}
+    for field in fields:
+        if field in task:
+            value = task[field]
+            projected[field] = value if value is None or isinstance(value, (str, int, float, bool, list, dict)) else str(value)
+    return projected
+
+
+def query_tasks(query: TaskQuery, raw: bool = False) -> List[Dict[str, Any]]:
+    """Tasks matching the filters, soonest due first, at most query.limit of them
+
+    raw=True returns the full task documents, eg. for the reminder check.
+    """
+    fields = query.fields or DEFAULT_TASK_FIELDS
+    if "_id" not in fields:
+        fields = ["_id"] + fields
+
+    if find_tasks is not None:
+        projection = None if raw else {field: 1 for field in fields}
+        tasks = find_tasks(task_filter(query), projection=projection, sort=[("due_date", 1)], limit=query.limit or 0)
+    else:
+        tasks = [task for task in get_tasks() if matches(task, query)]
+        tasks.sort(key=lambda task: parse_date(task.get("due_date")) or datetime.datetime.max)
+        if query.limit:
+            tasks = tasks[:query.limit]
+    return tasks if raw else [project(task, fields) for task in tasks]
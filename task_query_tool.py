@@ -0,0 +1,23 @@
+from typing import Any, Dict, List
+
+from langchain_core.tools import StructuredTool
+
+from models import TaskQuery
+from task_queries import query_tasks
+
+# The agent never gets more than this many tasks in one tool result
+MAX_TOOL_LIMIT = 50
+
+
+def _query_tasks_tool(**filters) -> List[Dict[str, Any]]:
+    query = TaskQuery(**filters)
+    query.limit = min(query.limit or MAX_TOOL_LIMIT, MAX_TOOL_LIMIT)
+    return query_tasks(query)
+
+
+query_tasks_tool = StructuredTool.from_function(
+    func=_query_tasks_tool,
+    name="query_tasks_tool",
+    description="Finds tasks matching filters (assignee, status, priority, channel, due window) and returns only the requested fields",
+    args_schema=TaskQuery,
+)
@@ -0,0 +1,187 @@
+import os
+from typing import Dict, List, Optional
+from pydantic import BaseModel, Field
+from langchain_core.messages import BaseMessage
+
+from metrics import registry
+
+PROMPT_TOKENS = registry.histogram("prompt_tokens", "Tokens per prompt component sent to the model", buckets=(64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384))
+PROMPT_TRIMMED_TOKENS = registry.counter("prompt_trimmed_tokens_total", "Tokens cut from prompt components to fit their budget")
+
+COMPONENTS = ("system", "tools", "roster", "context", "history", "user_message")
+TRUNCATED_MARKER = "\n[...truncated]"
+
+# Ollama is started with this context window (num_ctx) so prompts are never silently cut by the server
+MODEL_CONTEXT_TOKENS = int(os.getenv("MODEL_CONTEXT_TOKENS", 8192))
+
+_encoding = None
+
+
+def _get_encoding():
+    """tiktoken's cl100k_base when installed, it splits text close to llama3's tokenizer"""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(os.getenv("TOKENIZER_ENCODING", "cl100k_base"))
+        except Exception:
+            # No local tokenizer, fall back to about 4 characters per token
+            _encoding = False
+    return _encoding
+
+
+def count_tokens(text: str) -> int:
+    """Number of tokens in a text, counted with a local tokenizer"""
+    if not text:
+        return 0
+    encoding = _get_encoding()
+    if encoding:
+        return len(encoding.encode(text, disallowed_special=()))
+    return max(1, len(text) // 4)
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Keep the start of a text, cut at a line break where possible, so it fits max_tokens"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    max_tokens = max(0, max_tokens - count_tokens(TRUNCATED_MARKER))
+    encoding = _get_encoding()
+    head = encoding.decode(encoding.encode(text, disallowed_special=())[:max_tokens]) if encoding else text[:max_tokens * 4]
+    if "\n" in head:
+        head = head[:head.rindex("\n")]
+    return head + TRUNCATED_MARKER
+
+
+class PromptBudget(BaseModel):
+    """Token budgets for the parts of one agent prompt"""
+    context_tokens: int = Field(MODEL_CONTEXT_TOKENS, description="Context window the model runs with (num_ctx)")
+    output_tokens: int = Field(1024, description="Tokens kept free for the response")
+    system: int = Field(2500, description="System prompt including the task definition")
+    tools: int = Field(600, description="Tool descriptions")
+    roster: int = Field(1200, description="Employee list")
+    context: int = Field(2000, description="Retrieved documents")
+    history: int = Field(1500, description="Earlier messages of the conversation")
+    user_message: int = Field(2000, description="The message being answered, including a history window")
+
+
+def load_prompt_budget(agent_name: str) -> PromptBudget:
+    """Load an agent's budgets from the environment, eg. USER_REQUEST_BUDGET_CONTEXT=3000"""
+    prefix = agent_name.upper()
+    defaults = PromptBudget()
+    values = {
+        "context_tokens": MODEL_CONTEXT_TOKENS,
+        "output_tokens": int(os.getenv(f"{prefix}_OUTPUT_TOKENS", defaults.output_tokens)),
+    }
+    for component in COMPONENTS:
+        values[component] = int(os.getenv(f"{prefix}_BUDGET_{component.upper()}", getattr(defaults, component)))
+    return PromptBudget(**values)
+
+
+class PromptUsage:
+    """Fits the parts of one prompt into their budgets and keeps count of the tokens used"""
+
+    def __init__(self, agent_name: str, budget: PromptBudget):
+        self.agent_name = agent_name
+        self.budget = budget
+        self.tokens: Dict[str, int] = {}
+        self.trimmed: Dict[str, int] = {}
+
+    def _record(self, component: str, used: int, original: int):
+        self.tokens[component] = self.tokens.get(component, 0) + used
+        if original > used:
+            self.trimmed[component] = self.trimmed.get(component, 0) + original - used
+
+    def fixed(self, component: str, text: str) -> str:
+        """Count a prompt we wrote ourselves, instructions are never cut but going over budget is logged"""
+        tokens = count_tokens(text)
+        self._record(component, tokens, tokens)
+        if tokens > getattr(self.budget, component):
+            print(f"Warning: {self.agent_name} {component} prompt is {tokens} tokens, over its budget of {getattr(self.budget, component)}")
+        return text
+
+    def text(self, component: str, text: str) -> str:
+        """Keep the start of a text within the component's budget"""
+        original = count_tokens(text)
+        fitted = truncate_to_tokens(text, getattr(self.budget, component))
+        self._record(component, count_tokens(fitted), original)
+        return fitted
+
+    def lines(self, component: str, lines: List[str], max_tokens: Optional[int] = None) -> List[str]:
+        """Keep whole lines from the start, eg. employees in roster order"""
+        return self.documents(component, lines, separator_tokens=1, max_tokens=max_tokens)
+
+    def documents(self, component: str, documents: List[str], separator_tokens: int = 1, max_tokens: Optional[int] = None) -> List[str]:
+        """Keep documents in ranked order while they fit, the first one that doesn't is truncated"""
+        remaining = getattr(self.budget, component) if max_tokens is None else max_tokens
+        kept, used, original = [], 0, 0
+        for document in documents:
+            tokens = count_tokens(document) + separator_tokens
+            original += tokens
+            if remaining <= 0:
+                continue
+            if tokens > remaining:
+                document = truncate_to_tokens(document, remaining - separator_tokens)
+                tokens = count_tokens(document) + separator_tokens
+            kept.append(document)
+            used += tokens
+            remaining -= tokens
+        self._record(component, used, original)
+        return kept
+
+    def history(self, messages: List[BaseMessage], keep_last: int = 1, max_tokens: Optional[int] = None) -> List[BaseMessage]:
+        """Keep the newest messages that fit the history budget, the last keep_last are always kept"""
+        budget = self.budget.history if max_tokens is None else max_tokens
+        counts = [count_tokens(str(getattr(message, "content", message))) + 4 for message in messages]
+        start = len(messages)
+        used = 0
+        for index in range(len(messages) - 1, -1, -1):
+            if start > len(messages) - keep_last or used + counts[index] <= budget:
+                used += counts[index]
+                start = index
+            else:
+                break
+        self._record("history", used, sum(counts))
+        return messages[start:]
+
+    def conversation(self, messages: List[BaseMessage]) -> List[BaseMessage]:
+        """Fit a chat history whose last message is the one being answered
+
+        The last message is cut to the user_message budget, then the newest earlier messages
+        are kept while they fit both the history budget and what is left of the context window.
+        """
+        if not messages:
+            return []
+        *earlier, last = messages
+        content = str(getattr(last, "content", last))
+        fitted = self.text("user_message", content)
+        if fitted != content:
+            last = last.model_copy(update={"content": fitted}) if isinstance(last, BaseMessage) else fitted
+        earlier = self.history(earlier, keep_last=0, max_tokens=max(0, min(self.budget.history, self.available)))
+        return earlier + [last]
+
+    @property
+    def available(self) -> int:
+        """Tokens left in the context window after the output reserve"""
+        return self.budget.context_tokens - self.budget.output_tokens - sum(self.tokens.values())
+
+    def report(self):
+        """Log the tokens this prompt used"""
+        total = sum(self.tokens.values())
+        parts = " ".join(f"{component}={tokens}" for component, tokens in self.tokens.items())
+        trimmed = f" trimmed: {' '.join(f'{c}={t}' for c, t in self.trimmed.items())}" if self.trimmed else ""
+        print(f"Prompt tokens for {self.agent_name}: {parts} total={total}/{self.budget.context_tokens - self.budget.output_tokens}{trimmed}")
+        for component, tokens in self.tokens.items():
+            PROMPT_TOKENS.observe(tokens, agent=self.agent_name, component=component)
+        for component, tokens in self.trimmed.items():
+            PROMPT_TRIMMED_TOKENS.inc(tokens, agent=self.agent_name, component=component)
+
+
+class ContextBudgeter:
+    """Hands out a PromptUsage per model call with an agent's budgets"""
+
+    def __init__(self, agent_name: str, budget: Optional[PromptBudget] = None):
+        self.agent_name = agent_name
+        self.budget = budget or load_prompt_budget(agent_name)
+
+    def new_prompt(self) -> PromptUsage:
+        return PromptUsage(self.agent_name, self.budget)
@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import time
+import math
+import uuid
+import functools
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Dict, Iterable, List, Optional
+
+# Discord message id (or sweep id) the current work belongs to
+current_trace_id = contextvars.ContextVar("current_trace_id", default=None)
+current_span_id = contextvars.ContextVar("current_span_id", default=None)
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, math.ceil(pct / 100 * len(ordered)) - 1)
+    return ordered[index]
+
+
+def summarize_spans(spans: Iterable[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """Summarize span durations as count/p50/p95/p99 per stage"""
+    durations: Dict[str, List[float]] = {}
+    for span in spans:
+        durations.setdefault(span["stage"], []).append(span["duration_ms"])
+
+    return {
+        stage: {
+            "count": len(values),
+            "p50_ms": round(percentile(values, 50), 2),
+            "p95_ms": round(percentile(values, 95), 2),
+            "p99_ms": round(percentile(values, 99), 2),
+        }
+        for stage, values in durations.items()
+    }
+
+
+class Tracer:
+    """Records timing spans for each stage of the agent pipeline"""
+
+    def __init__(self, max_spans: int = 10000, export_path: Optional[str] = None):
+        self.spans = deque(maxlen=max_spans)
+        self.export_path = export_path
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def trace(self, trace_id: Any):
+        """Attach every span recorded inside this block to trace_id"""
+        token = current_trace_id.set(str(trace_id))
+        try:
+            yield
+        finally:
+            current_trace_id.reset(token)
+
+    @contextmanager
+    def span(self, stage: str, **attributes):
+        """Time a block of work, the yielded dict can be filled with extra attributes"""
+        span_id = uuid.uuid4().hex[:16]
+        record = {
+            "trace_id": current_trace_id.get(),
+            "span_id": span_id,
+            "parent_id": current_span_id.get(),
+            "stage": stage,
+            "start": time.time(),
+            **attributes,
+        }
+        token = current_span_id.set(span_id)
+        started = time.perf_counter()
+        try:
+            yield record
+        except Exception as e:
+            record["error"] = str(e)
+            raise
+        finally:
+            record["duration_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            current_span_id.reset(token)
+            self.record(record)
+
+    def record(self, record: Dict[str, Any]):
+        with self.lock:
+            self.spans.append(record)
+            if self.export_path:
+                with open(self.export_path, "a") as f:
+                    f.write(json.dumps(record, default=str) + "\n")
+
+    def drain(self) -> List[Dict[str, Any]]:
+        """Take every recorded span out of the tracer, eg. to hand a worker's spans to the gateway"""
+        with self.lock:
+            spans = list(self.spans)
+            self.spans.clear()
+        return spans
+
+    def get_trace(self, trace_id: Any) -> List[Dict[str, Any]]:
+        """Return all recorded spans for a Discord message id"""
+        with self.lock:
+            return [span for span in self.spans if span["trace_id"] == str(trace_id)]
+
+    def export_jsonl(self, path: str):
+        """Write all recorded spans to a JSON lines file"""
+        with self.lock:
+            spans = list(self.spans)
+        with open(path, "w") as f:
+            for span in spans:
+                f.write(json.dumps(span, default=str) + "\n")
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        with self.lock:
+            spans = list(self.spans)
+        return summarize_spans(spans)
+
+
+def traced(stage: str):
+    """Decorator that records a span for every call of a graph node"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_llm_usage(span: Dict[str, Any], response):
+    """Copy token counts from a chat model response onto a span"""
+    usage = getattr(response, "usage_metadata", None) or {}
+    span["prompt_tokens"] = usage.get("input_tokens")
+    span["completion_tokens"] = usage.get("output_tokens")
+
+
+tracer = Tracer(export_path=os.getenv("TRACE_FILE"))
+
+
+if __name__ == "__main__":
+    # Summarize an exported trace file, eg. python tracing.py traces.jsonl
+    with open(sys.argv[1]) as f:
+        spans = [json.loads(line) for line in f if line.strip()]
+    for stage, stats in sorted(summarize_spans(spans).items()):
+        print(f"{stage:<20} count={stats['count']:<6} p50={stats['p50_ms']}ms p95={stats['p95_ms']}ms p99={stats['p99_ms']}ms")
@@ -0,0 +1,115 @@
+import os
+import asyncio
+from typing import AsyncIterator, List
+
+from models import ChatLine, ChatWindow
+from token_budget import count_tokens
+from src.langchain_tools.utils.utils import remove_angle_bracket_content
+
+# Token budget of the MESSAGES part of one ingestor prompt and how much of it is repeated in the next window
+WINDOW_TOKENS = int(os.getenv("HISTORY_WINDOW_TOKENS", 600))
+WINDOW_OVERLAP_TOKENS = int(os.getenv("HISTORY_WINDOW_OVERLAP_TOKENS", 60))
+# Windows never shrink below this to make room for the roster, the roster is cut instead
+MIN_WINDOW_TOKENS = int(os.getenv("HISTORY_MIN_WINDOW_TOKENS", 200))
+
+_END = object()
+
+
+def estimate_tokens(text: str) -> int:
+    """Token count of a chat line, at least 1 so empty lines still take a slot"""
+    return max(1, count_tokens(text))
+
+
+def normalize_message(message, channel_name: str) -> ChatLine:
+    """Turn a discord.py message into the line format the ingestor prompt expects"""
+    user_mentions = [mention.name for mention in message.mentions]
+    text = remove_angle_bracket_content(f"{message.author.name} said: '{' and '.join(user_mentions)} {message.content} \n")
+    return ChatLine(
+        message_id=message.id,
+        channel=channel_name,
+        author=message.author.name,
+        content=message.content,
+        created_at=message.created_at,
+        user_mentions=user_mentions,
+        text=text,
+        tokens=estimate_tokens(text),
+    )
+
+
+async def iter_chat_lines(history, channel_name: str) -> AsyncIterator[ChatLine]:
+    """Lazily normalize messages as channel.history() pages them in"""
+    async for message in history:
+        if not message.content:
+            continue
+        yield normalize_message(message, channel_name)
+
+
+def split_line(line: ChatLine, max_tokens: int) -> List[ChatLine]:
+    """Split a line that doesn't fit in one window into window sized pieces"""
+    if line.tokens <= max_tokens:
+        return [line]
+
+    chunk_chars = max(1, len(line.text) * max_tokens // line.tokens)
+    pieces = []
+    for start in range(0, len(line.text), chunk_chars):
+        text = line.text[start:start + chunk_chars]
+        if start + chunk_chars < len(line.text):
+            text += "\n"
+        pieces.append(line.model_copy(update={"text": text, "tokens": estimate_tokens(text)}))
+    return pieces
+
+
+async def iter_windows(lines: AsyncIterator[ChatLine], max_tokens: int = WINDOW_TOKENS, overlap_tokens: int = WINDOW_OVERLAP_TOKENS) -> AsyncIterator[ChatWindow]:
+    """Pack chat lines into windows of at most max_tokens, repeating up to overlap_tokens of context between windows"""
+    overlap_tokens = min(overlap_tokens, max_tokens // 2)
+    window: List[ChatLine] = []
+    window_tokens = 0
+    new_lines = 0  # lines in the window that weren't carried over from the previous one
+
+    async for line in lines:
+        for piece in split_line(line, max_tokens):
+            if window and window_tokens + piece.tokens > max_tokens:
+                yield ChatWindow(lines=window, tokens=window_tokens)
+
+                # Carry the tail of the window over so tasks spanning two windows aren't lost
+                carried: List[ChatLine] = []
+                carried_tokens = 0
+                for previous in reversed(window):
+                    if carried_tokens + previous.tokens > overlap_tokens or carried_tokens + previous.tokens + piece.tokens > max_tokens:
+                        break
+                    carried.insert(0, previous)
+                    carried_tokens += previous.tokens
+                window, window_tokens, new_lines = carried, carried_tokens, 0
+
+            window.append(piece)
+            window_tokens += piece.tokens
+            new_lines += 1
+
+    if new_lines:
+        yield ChatWindow(lines=window, tokens=window_tokens)
+
+
+async def prefetch(items: AsyncIterator, size: int = 2) -> AsyncIterator:
+    """Keep pulling up to size items ahead from a producer while the consumer works"""
+    queue = asyncio.Queue(maxsize=size)
+
+    async def produce():
+        try:
+            async for item in items:
+                await queue.put(item)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            await queue.put(_END)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        producer.cancel()